@@ -1 +1,9 @@
+## dive.Scene is imported on first use so `import dive` and the CLI startup stay cheap
+__all__ = ['Scene']
 
+
+def __getattr__(name):
+    if name == 'Scene':
+        from dive.scene import Scene
+        return Scene
+    raise AttributeError(f"module 'dive' has no attribute {name!r}")
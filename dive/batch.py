@@ -0,0 +1,257 @@
+import os
+import csv
+import time
+import argparse
+import multiprocessing
+import pyvista as pv
+import nibabel as nib
+from dive.loading import load
+from dive.showman import Show
+from fury.io import save_image
+from dive.csv_tocolors import Colors_csv
+from dive.helper import load_3dbrain, load_2dbrain, Colors, Mesh
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+## Shared scene of a worker process, built once by init_worker and reused by its rows
+worker_scene = None
+
+
+def read_manifest(manifest_path):
+    """
+    Reads the batch manifest, a CSV file with one row per subject.
+    Args:
+        manifest_path: path to the manifest. The 'output' column is required, the optional
+        columns are tract, mask, mesh (space separated paths), stats_csv, colors_tract,
+        colors_mask, colors_mesh (comma separated colors) and view.
+    Returns:
+        rows: list of dicts with the stripped non-empty cells of each row
+    """
+    with open(manifest_path, newline='') as manifest_file:
+        reader = csv.DictReader(manifest_file)
+        rows = [{k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()} for row in reader]
+    return rows
+
+
+def build_subject(row, args):
+    """
+    Builds the actors of one manifest row.
+    Args:
+        row: dict of the manifest row
+        args: parsed batch arguments (width, stats coloring options)
+        The color bar of a stats_csv row is saved next to the row output, when it has one.
+    Returns:
+        actors: list of actors to add to the shared scene
+    """
+    colors_caller = Colors()
+    colors_tract = colors_caller.string_to_list(input_string = row['colors_tract']) if 'colors_tract' in row else []
+    colors_mask = colors_caller.string_to_list(input_string = row['colors_mask']) if 'colors_mask' in row else []
+    colors_mesh = colors_caller.string_to_list(input_string = row['colors_mesh']) if 'colors_mesh' in row else []
+    color_map_mask = []
+    if 'stats_csv' in row:
+        cc = Colors_csv(row['stats_csv'])
+        output = os.path.splitext(row['output'])[0] if row.get('output') else None
+        color_map_mask = cc.assign_colors(map=args.map,range_value=args.range_value,log_p_value=args.log_p_value,threshold=args.threshold,output=output)
+
+    actors = []
+    load_caller = load()
+    for i, path in enumerate(row.get('mask', '').split()):
+        color = colors_mask[i] if len(colors_mask) > i else None
+        actors.append(load_caller.load_mask(mask_args = path,color_map_mask=color_map_mask,color=color))
+    for i, path in enumerate(row.get('tract', '').split()):
+        color = colors_tract[i] if len(colors_tract) > i else None
+        actors.append(load_caller.load_tract(tract_args = path,tract_width=args.width_tract,tract_color=color,color_map_csv_mask=color_map_mask))
+    for i, path in enumerate(row.get('mesh', '').split()):
+        color = colors_mesh[i] if len(colors_mesh) > i else Colors.get_tab20_color(index = i, type_='vtk')
+        actors.append(Mesh(pv.PolyData(path),color).load_mesh())
+    return [a for a in actors if a is not None]
+
+
+def open_scene(args):
+    """
+    Builds the shared actors (glass brain, 2D brain) in a new scene.
+    Returns:
+        ui_caller, scene, render_window: the Show, its scene and the offscreen window
+    """
+    ui_caller = Show(background=args.background)
+    scene = ui_caller.define_scene()
+
+    ## Shared actors, loaded once for all the rows
+    if args.glass_brain:
+        scene.add(load_3dbrain(nib.load(args.glass_brain)).loading())
+    if args.brain_2d:
+        caller_2d = load_2dbrain(nib.load(args.brain_2d[0]))
+        slice_actor = caller_2d.load_actor()
+        ui_caller.define_maxview(min(caller_2d.data.shape),slice_actor = slice_actor)
+        scene.add(slice_actor)
+        if len(args.brain_2d)>1:
+            ui_caller.slice_actorvalues(args.brain_2d[1:])
+
+    return ui_caller, scene, ui_caller.offscreen_window(tuple(args.size))
+
+
+def close_scene(scene, render_window):
+    render_window.RemoveRenderer(scene)
+    render_window.Finalize()
+
+
+def render_rows(args, indexed_rows, shared=None):
+    """
+    Renders a list of manifest rows with one offscreen window. The shared actors (glass
+    brain, 2D brain) are built once, only the subject actors are swapped between rows.
+    A failing row is reported and skipped.
+    Args:
+        args: parsed batch arguments
+        indexed_rows: list of (row index, row dict)
+        shared: (ui_caller, scene, render_window) from open_scene kept open by the caller,
+        a scene is built and closed for these rows if None
+    Returns:
+        timings: list of dicts with the load and render time and status of every row
+    """
+    ui_caller, scene, render_window = shared if shared is not None else open_scene(args)
+    timings = []
+    with ThreadPoolExecutor(max_workers=1) as encoder:
+        saving = []
+        for index, row in indexed_rows:
+            output = row.get('output')
+            actors = []
+            t0 = time.perf_counter()
+            try:
+                if not output: raise ValueError('the row has no output')
+                ## An unknown view would keep the camera of the previous row
+                view = row.get('view', args.view)
+                if view not in Show.CAM_SETTINGS: raise ValueError(f"invalid view {view}, choose from {list(Show.CAM_SETTINGS.keys())}")
+                actors = build_subject(row, args)
+                scene.add(*actors)
+                t1 = time.perf_counter()
+                image = ui_caller.render_view(render_window, view)
+                t2 = time.perf_counter()
+                fname = output if output.endswith('.png') else output + '.png'
+                timing = {'row': index, 'output': fname, 'load_s': round(t1 - t0, 3), 'render_s': round(t2 - t1, 3), 'status': 'ok'}
+                saving.append((encoder.submit(save_image, image, fname), timing))
+                timings.append(timing)
+                print(f"[row {index}] {fname}: load {t1 - t0:.2f} s, render {t2 - t1:.2f} s")
+            except Exception as error:
+                timings.append({'row': index, 'output': output, 'load_s': round(time.perf_counter() - t0, 3), 'render_s': None, 'status': f'failed: {error}'})
+                print(f"[row {index}] {output}: failed ({error})")
+            finally:
+                for subject_actor in actors:
+                    scene.rm(subject_actor)
+        ## A row only counts as rendered once its image is written, a failed write fails that row alone
+        for future, timing in saving:
+            try:
+                future.result()
+            except Exception as error:
+                timing['status'] = f'failed: {error}'
+                print(f"[row {timing['row']}] {timing['output']}: failed to save ({error})")
+    if shared is None: close_scene(scene, render_window)
+    return timings
+
+
+def init_worker(args):
+    global worker_scene
+    worker_scene = open_scene(args)
+
+
+def render_rows_in_worker(args, indexed_rows):
+    return render_rows(args, indexed_rows, shared=worker_scene)
+
+
+def run_pool(args, rows, workers, results):
+    """
+    Renders rows on a fresh pool, one job per row, filling results with the finished rows.
+    Returns: True when a worker process crashed and broke the pool
+    """
+    broken = False
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(args,)) as pool:
+        futures = [(pool.submit(render_rows_in_worker, args, [(index, row)]), index, row) for index, row in rows]
+        for future, index, row in futures:
+            try:
+                results[index] = future.result()[0]
+            except BrokenProcessPool:
+                broken = True
+            except Exception as error:
+                results[index] = {'row': index, 'output': row.get('output'), 'load_s': None, 'render_s': None, 'status': f'worker failed: {error}'}
+    return broken
+
+
+def render_in_workers(args, indexed_rows, workers):
+    """
+    Renders the rows on worker processes, one job per row so a finished row keeps its result
+    whatever happens to the other workers. A crashing worker (e.g. a VTK segfault) breaks
+    the whole pool: the rows that were in flight are run again one at a time, where the
+    first unfinished one is the row that crashed. That row is marked failed and the other
+    rows go back to the full pool.
+    Args:
+        args: parsed batch arguments
+        indexed_rows: list of (row index, row dict)
+        workers: number of worker processes
+    Returns:
+        timings: list of dicts with the load and render time and status of every row
+    """
+    results, pending, suspects = {}, list(indexed_rows), []
+    while pending or suspects:
+        if suspects:
+            broken = run_pool(args, suspects, 1, results)
+            suspects = [(index, row) for index, row in suspects if index not in results]
+            if broken and suspects:
+                index, row = suspects.pop(0)
+                results[index] = {'row': index, 'output': row.get('output'), 'load_s': None, 'render_s': None, 'status': 'failed: the worker process crashed'}
+                print(f"[row {index}] {row.get('output')}: failed (the worker process crashed)")
+            elif not broken:
+                suspects = []
+            continue
+        broken = run_pool(args, pending, workers, results)
+        pending = [(index, row) for index, row in pending if index not in results]
+        if broken:
+            ## Jobs reach the workers in order, at most workers + 1 at a time (the call queue of
+            ## ProcessPoolExecutor), so the crashing row is among the first unfinished ones
+            suspects, pending = pending[:workers + 1], pending[workers + 1:]
+            print(f"A worker process crashed, rendering the {len(suspects)} rows in flight again one at a time")
+        else:
+            pending = []
+    return [results[index] for index, _ in indexed_rows]
+
+
+def run_batch(argv=None):
+    """
+    Renders every row of a manifest, in this process or spread across worker processes
+    that each own their offscreen render window. A failing row, or a row crashing its
+    worker, is the only one marked as failed.
+    Args:
+        argv: command line arguments after 'batch'
+    """
+    formatter = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(prog='dive batch', description='Render many subjects from a manifest CSV', formatter_class=formatter)
+    parser.add_argument('manifest', help='CSV with an output column and any of tract, mask, mesh, stats_csv, colors_tract, colors_mask, colors_mesh, view')
+    parser.add_argument('--glass_brain', help='A NIfTI binary file for a 3D brain shared by all subjects')
+    parser.add_argument('--brain_2d', nargs='+', help='A NIfTI file for a 2D brain image shared by all subjects')
+    parser.add_argument('--background', type=int, default=0, help='Choice either black or white Background color choice: 0 for black, 1 for white')
+    parser.add_argument('--view', default='Coronal_A', help='Camera view used when the row has no view column')
+    parser.add_argument('--size', nargs=2, type=int, default=[2000, 2000], help='Width and height of the images')
+    parser.add_argument('--width_tract', type=int, default=1, help='Specify the width of the streamlines')
+    parser.add_argument('--threshold',type=float,default=0.05, help='Threshold value for visualization')
+    parser.add_argument('--log_p_value', type=bool, default=False, help='Use logarithmic p-values (True/False)')
+    parser.add_argument('--range_value', nargs=2, type=float, default=None, help='Minimum and maximum values for the value range')
+    parser.add_argument('--map', help='Colormap name from Matplotlib', type=str, default = 'RdBu')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes, each with its own offscreen window')
+    parser.add_argument('--timings', default=None, help='Path to a CSV file to write the per-subject timings')
+    args = parser.parse_args(argv)
+
+    indexed_rows = list(enumerate(read_manifest(args.manifest)))
+    workers = max(1, min(args.workers, len(indexed_rows)))
+    start = time.perf_counter()
+    if workers == 1:
+        timings = render_rows(args, indexed_rows)
+    else:
+        timings = render_in_workers(args, indexed_rows, workers)
+
+    total = time.perf_counter() - start
+    done = sum(t['status'] == 'ok' for t in timings)
+    print(f"Rendered {done}/{len(indexed_rows)} subjects in {total:.1f} s with {workers} worker(s) ({60 * done / total if total > 0 else 0:.1f} images/min)")
+    if args.timings:
+        with open(args.timings, 'w', newline='') as timings_file:
+            writer = csv.DictWriter(timings_file, fieldnames=['row', 'output', 'load_s', 'render_s', 'status'])
+            writer.writeheader()
+            writer.writerows(timings)
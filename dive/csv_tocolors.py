@@ -1,21 +1,67 @@
 import os
-import matplotlib
-import collections
+import shutil
 import numpy as np
-import pandas as pd
-from math import isnan
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
+## pandas and matplotlib are only imported when a stats table is colored, Tract
+## subclasses Colors_csv and must stay cheap to import
+
+## Color bars already rendered in this process, keyed by (map, min, max)
+color_bar_cache = {}
 
 class Colors_csv():
+    ## Columns read from the stats tables, in the order used by unnamed NPY arrays
+    columns = ['Labels','P_value','Value','Name']
+
     def __init__(self,stats_csv=None):
         self.csv_flag = None
         self.colors_from_csv = []
         self.stats_csv = stats_csv
         self.map = None
+        self.threshold = None
+        self.norm = None
+        self.raw_df = None
 
     def load_csv(self): 
-        self.df = pd.read_csv(self.stats_csv)
+        ## Parse the file once, later calls start again from a copy of the parsed table
+        if self.raw_df is None:
+            self.raw_df = self.read_table(self.stats_csv)
+        self.df = self.raw_df.copy()
+
+    def read_table(self,path):
+        """
+        Reads the stats table, only touching the columns used for coloring.
+        Supports CSV, Feather and Parquet tables (memory mapped through pyarrow),
+        NPY files holding a structured array with named fields or a (rows, 3) array
+        of Labels, P_value, Value, and NPZ archives with one array per column.
+        Args:
+            path: path to the stats file
+        Returns:
+            df: pandas DataFrame with the available stats columns
+        """
+        import pandas as pd
+        extension = path.lower().rsplit('.', 1)[-1]
+        if extension == 'feather':
+            import pyarrow.feather as feather
+            import pyarrow.ipc as ipc
+            ## Only the needed columns are read and decompressed
+            with ipc.open_file(path) as reader:
+                names = reader.schema.names
+            return feather.read_table(path, columns=[c for c in self.columns if c in names], memory_map=True).to_pandas()
+        if extension == 'parquet':
+            import pyarrow.parquet as pq
+            names = pq.read_schema(path, memory_map=True).names
+            columns = [c for c in self.columns if c in names]
+            return pd.read_parquet(path, columns=columns, memory_map=True)
+        if extension == 'npy':
+            data = np.load(path, mmap_mode='r')
+            if data.dtype.names:
+                return pd.DataFrame({c: data[c] for c in self.columns if c in data.dtype.names}, copy=False)
+            if data.ndim != 2:
+                raise ValueError(f"{path} holds a {data.ndim}-D array, expected a (rows, 3) array of Labels, P_value, Value or a structured array with named fields")
+            return pd.DataFrame({c: data[:, k] for k, c in enumerate(self.columns[:data.shape[1]])}, copy=False)
+        if extension == 'npz':
+            with np.load(path) as data:
+                return pd.DataFrame({c: data[c] for c in self.columns if c in data.files})
+        return pd.read_csv(path, usecols=lambda c: c in self.columns)
 
     def intialize(self,log_p_value=False):
         if log_p_value:
@@ -30,52 +76,150 @@ class Colors_csv():
         self.map = map
         if group==0: self.load_csv()
         self.intialize(log_p_value)
+        self.data_min, self.data_max = self.min_value, self.max_value
+        import matplotlib.cm
         cmap = matplotlib.cm.get_cmap(map)
-        di = {}
         if range_value and len(range_value)>0:
             self.min_value = range_value[0]
             self.max_value = range_value[1]
             self.csv_flag = True
-            self.df.sort_values(by=['Labels'],inplace=True)
-
-        norm = mcolors.Normalize(vmin=self.min_value, vmax=self.max_value)
-        self.df['Value_n'] = norm(self.df[self.col_name])
-
-        for i,k,j in zip(self.df['Value_n'],self.df['P_value'],self.df['Labels']):
-            if self.csv_flag == True:
-                if k>threshold:
-                    r=g=b=0.5
-                else:
-                    if i!= None and self.min_value<=i<=self.max_value:  
-                        r,g,b,a = cmap(i)
-                    if i>self.max_value:
-                        r,g,b,a = cmap(self.max_value)
-                    if i<self.min_value:
-                        r,g,b,a = cmap(self.min_value)
-            else:
-                r,g,b,a = cmap(i)
-            di[j] = [r,g,b]
-        clean_dict = {k: di[k] for k in di if not isnan(k)}
-        clean_dict = collections.OrderedDict(sorted(clean_dict.items()))
-        for k, v in clean_dict.items():
-            self.colors_from_csv.append(v)
-        self.colors_from_csv = np.asarray(self.colors_from_csv)
+        self.threshold = threshold
+        self.compute_colors(cmap)
 
         ## Save the color bar images
-        fig, ax = plt.subplots(figsize=(6, 1))
-        # print(self.df[self.col_name])
         if output!=None:
-            sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-            sm.set_array([])
-            cb = fig.colorbar(sm, cax=ax,orientation='horizontal') # 
-            # cb.ax.tick_params(labelsize=10) 
-            plt.savefig((output + filename) , bbox_inches='tight', dpi=300)
+            self.save_color_bar(output + filename, cmap=cmap)
         return self.colors_from_csv
 
+    def save_color_bar(self,path,cmap=None,vmin=None,vmax=None):
+        """
+        Renders the color bar of the current map and range to path. Each
+        (map, min, max, file format) combination is rendered once per process,
+        later requests copy the already rendered file.
+        Args:
+            path: output file of the color bar
+            cmap: matplotlib colormap, defaults to the one named by self.map
+            vmin, vmax: range of the color bar, defaults to the current range
+        """
+        if vmin is None: vmin = self.min_value
+        if vmax is None: vmax = self.max_value
+        ## savefig picks the format from the extension, a PNG must not be copied from a PDF
+        key = (self.map, float(vmin), float(vmax), os.path.splitext(path)[1].lower())
+        rendered = color_bar_cache.get(key)
+        if rendered == path and os.path.exists(path): return
+        if rendered is not None and os.path.exists(rendered):
+            shutil.copyfile(rendered, path)
+            return
+        import matplotlib.cm
+        import matplotlib.colors as mcolors
+        ## Draw on a standalone Figure so pyplot is never imported and nothing is left open
+        from matplotlib.figure import Figure
+        from matplotlib.cm import ScalarMappable
+        if cmap is None: cmap = matplotlib.cm.get_cmap(self.map)
+        fig = Figure(figsize=(6, 1))
+        ax = fig.subplots()
+        sm = ScalarMappable(cmap=cmap, norm=mcolors.Normalize(vmin=vmin, vmax=vmax))
+        sm.set_array([])
+        fig.colorbar(sm, cax=ax, orientation='horizontal')
+        fig.savefig(path, bbox_inches='tight', dpi=300)
+        color_bar_cache[key] = path
+
+    def compute_colors(self,cmap=None):
+        """
+        Computes one RGB color per label from the loaded table using the current
+        colormap, value range and threshold.
+        Args:
+            cmap: matplotlib colormap, defaults to the one named by self.map
+        Returns:
+            colors_from_csv: array (number of labels, 3) sorted by label
+        """
+        import matplotlib.cm
+        import matplotlib.colors as mcolors
+        if cmap is None: cmap = matplotlib.cm.get_cmap(self.map)
+
+        ## Normalize, clip to the range and map the whole column at once
+        self.norm = mcolors.Normalize(vmin=self.min_value, vmax=self.max_value)
+        values_n = np.ma.filled(self.norm(self.df[self.col_name].to_numpy(dtype=float)), np.nan)
+        self.df['Value_n'] = values_n
+        rgb = cmap(np.clip(values_n, 0.0, 1.0))[:, :3]
+        if self.csv_flag == True and self.threshold is not None:
+            rgb[self.df['P_value'].to_numpy(dtype=float) > self.threshold] = 0.5
+
+        ## One color per label, sorted by label (the last row wins for duplicated labels)
+        labels = self.df['Labels'].to_numpy(dtype=float)
+        valid = ~np.isnan(labels)
+        labels, rgb = labels[valid][::-1], rgb[valid][::-1]
+        _, first_index = np.unique(labels, return_index=True)
+        self.colors_from_csv = rgb[first_index]
+        return self.colors_from_csv
+
+    def recolor(self,threshold=None,range_value=None,map=None):
+        """
+        Recomputes the label colors of an already loaded table without reading
+        the CSV again, used to update lookup tables from the UI.
+        Args:
+            threshold: new P_value threshold, rows above it are greyed
+            range_value: new (min, max) of the color range
+            map: new matplotlib colormap name
+        Returns:
+            colors_from_csv: array (number of labels, 3) sorted by label
+        """
+        if map is not None: self.map = map
+        if threshold is not None:
+            self.threshold = threshold
+            self.csv_flag = True
+        if range_value is not None:
+            self.min_value, self.max_value = range_value
+        return self.compute_colors()
+
     def assign_colors_grp(self,map,range_value=[],log_p_value=False,threshold=None,output=None,filename='_color_bar.pdf',group=1):
+        """
+        Colors every 'Name' group of the table in a single pass. Without range_value
+        each group is normalized by its own minimum and maximum.
+        Returns:
+            colors_grp: dict mapping each group name to its colors (number of labels, 3) sorted by label
+        """
+        self.map = map
         self.load_csv()
-        grouped = self.df.groupby('Name')
-        for name, group in grouped:
-            self.df = group
-            # print(name)
-            return self.assign_colors(map = map,range_value=range_value,log_p_value=log_p_value,threshold=threshold,output=output,filename=filename,group=1)
\ No newline at end of file
+        self.intialize(log_p_value)
+        self.data_min, self.data_max = self.min_value, self.max_value
+        import matplotlib.cm
+        cmap = matplotlib.cm.get_cmap(map)
+        values = self.df[self.col_name].to_numpy(dtype=float)
+        if range_value and len(range_value)>0:
+            self.min_value = range_value[0]
+            self.max_value = range_value[1]
+            self.csv_flag = True
+            vmin = np.full(len(values), float(self.min_value))
+            vmax = np.full(len(values), float(self.max_value))
+        else:
+            grouped = self.df.groupby('Name')[self.col_name]
+            vmin = grouped.transform('min').to_numpy(dtype=float)
+            vmax = grouped.transform('max').to_numpy(dtype=float)
+        self.threshold = threshold
+
+        ## Normalize every row by the range of its group, then map the whole column at once
+        span = vmax - vmin
+        values_n = np.where(span > 0, (values - vmin) / np.where(span > 0, span, 1.0), 0.0)
+        values_n[np.isnan(values)] = np.nan
+        rgb = cmap(np.clip(values_n, 0.0, 1.0))[:, :3]
+        if self.csv_flag == True and self.threshold is not None:
+            rgb[self.df['P_value'].to_numpy(dtype=float) > self.threshold] = 0.5
+
+        ## One color per (group, label), sorted by group then label (the last row wins for duplicates)
+        import pandas as pd
+        table = pd.DataFrame({'Name': self.df['Name'].to_numpy(), 'Labels': self.df['Labels'].to_numpy(dtype=float), 'row': np.arange(len(rgb))})
+        table = table.dropna(subset=['Labels']).drop_duplicates(subset=['Name','Labels'], keep='last')
+        table = table.sort_values(by=['Name','Labels'], kind='stable')
+        names, starts = np.unique(table['Name'].to_numpy(), return_index=True)
+        self.colors_grp = dict(zip(names, np.split(rgb[table['row'].to_numpy()], starts[1:])))
+
+        ## Save the color bar images, one per group when each group has its own range
+        if output!=None:
+            if self.csv_flag == True:
+                self.save_color_bar(output + filename, cmap=cmap)
+            else:
+                group_range = self.df.groupby('Name')[self.col_name].agg(['min','max'])
+                for name, (group_min, group_max) in group_range.iterrows():
+                    self.save_color_bar(f"{output}_{name}{filename}", cmap=cmap, vmin=group_min, vmax=group_max)
+        return self.colors_grp
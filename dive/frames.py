@@ -0,0 +1,128 @@
+import os
+import json
+import numpy as np
+from fury.io import save_image
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import imageio
+except ImportError:
+    imageio = None
+
+
+def turntable_cameras(frames, position, focal, view_up):
+    """
+    Args:
+        frames: number of frames of the full turn
+        position, focal, view_up: starting camera
+    Returns:
+        cameras: list of (position, focal, view_up), the camera rotating around the view up
+        axis through the focal point
+    """
+    position, focal = np.asarray(position, dtype=float), np.asarray(focal, dtype=float)
+    axis = np.asarray(view_up, dtype=float) / np.linalg.norm(view_up)
+    offset = position - focal
+    cameras = []
+    for angle in np.linspace(0, 2 * np.pi, frames, endpoint=False):
+        ## Rodrigues rotation of the eye around the axis
+        rotated = offset * np.cos(angle) + np.cross(axis, offset) * np.sin(angle) + axis * np.dot(axis, offset) * (1 - np.cos(angle))
+        cameras.append((tuple(focal + rotated), tuple(focal), tuple(view_up)))
+    return cameras
+
+
+def camera_path_cameras(path, frames=None, views=None):
+    """
+    Args:
+        path: JSON file with a list of key cameras, either view names (keys of views) or
+        dicts with position, focal and view_up
+        frames: number of frames, interpolated between the key cameras (one frame per key
+        camera if None)
+        views: dict of named cameras (Show.CAM_SETTINGS)
+    Returns:
+        cameras: list of (position, focal, view_up)
+    """
+    with open(path) as path_file:
+        keys = json.load(path_file)
+    keys = [views[key] if isinstance(key, str) else key for key in keys]
+    positions, focals, ups = (np.array([key[field] for key in keys], dtype=float) for field in ('position', 'focal', 'view_up'))
+    if frames is None: frames = len(keys)
+    cameras = []
+    for t in np.linspace(0, len(keys) - 1, frames):
+        k = min(int(t), len(keys) - 2) if len(keys) > 1 else 0
+        u = t - k
+        k1 = min(k + 1, len(keys) - 1)
+        ## The eye moves on a sphere around the focal point: the direction of position - focal is
+        ## slerped and its length lerped, so opposite views orbit instead of crossing the focal point
+        focal = (1 - u) * focals[k] + u * focals[k1]
+        offset0, offset1 = positions[k] - focals[k], positions[k1] - focals[k1]
+        radius = (1 - u) * np.linalg.norm(offset0) + u * np.linalg.norm(offset1)
+        up = (1 - u) * ups[k] + u * ups[k1]
+        direction = slerp(offset0 / np.linalg.norm(offset0), offset1 / np.linalg.norm(offset1), u, up)
+        cameras.append((tuple(focal + radius * direction), tuple(focal), tuple(orthogonal_up(up, direction))))
+    return cameras
+
+
+def slerp(d0, d1, u, up):
+    """
+    Returns: unit vector a fraction u of the way from d0 to d1 on the great circle, opposite
+    directions turn around the up vector
+    """
+    cos_angle = np.clip(np.dot(d0, d1), -1.0, 1.0)
+    if cos_angle > 0.9995:
+        d = (1 - u) * d0 + u * d1
+        return d / np.linalg.norm(d)
+    angle = np.arccos(cos_angle)
+    if np.sin(angle) < 1e-6:
+        ## No unique great circle between opposite directions: rotate in the plane normal to up
+        ortho = np.cross(up, d0)
+        if np.linalg.norm(ortho) < 1e-6: ortho = np.cross([1.0, 0.0, 0.0] if abs(d0[0]) < 0.9 else [0.0, 1.0, 0.0], d0)
+        ortho /= np.linalg.norm(ortho)
+        return d0 * np.cos(u * np.pi) + ortho * np.sin(u * np.pi)
+    return (np.sin((1 - u) * angle) * d0 + np.sin(u * angle) * d1) / np.sin(angle)
+
+
+def orthogonal_up(up, direction):
+    """
+    Returns: the view up made orthogonal to the view direction (Gram-Schmidt), any
+    perpendicular vector when they are parallel
+    """
+    up = np.asarray(up, dtype=float) - np.dot(up, direction) * direction
+    if np.linalg.norm(up) < 1e-6:
+        up = np.cross(direction, [1.0, 0.0, 0.0] if abs(direction[0]) < 0.9 else [0.0, 1.0, 0.0])
+    return up / np.linalg.norm(up)
+
+
+class FrameEncoder:
+    """
+    Writes rendered frames in the background while the next ones render: PNG files on a pool
+    of threads, or an MP4 (imageio) on one thread to keep the frame order. At most
+    max_pending frames wait in memory.
+    """
+
+    def __init__(self, output_dir, video=None, fps=30, workers=4, max_pending=8):
+        self.output_dir = output_dir
+        self.writer = None
+        if video and imageio is None:
+            print("imageio is not installed, saving a PNG sequence instead of the video")
+        elif video:
+            self.writer = imageio.get_writer(video, fps=fps)
+            workers = 1
+        if self.writer is None: os.makedirs(output_dir, exist_ok=True)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending
+        self.pending = []
+        self.count = 0
+
+    def submit(self, image):
+        if len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        if self.writer is not None:
+            self.pending.append(self.pool.submit(self.writer.append_data, image))
+        else:
+            self.pending.append(self.pool.submit(save_image, image, os.path.join(self.output_dir, f"frame_{self.count:05d}.png")))
+        self.count += 1
+
+    def close(self):
+        for future in self.pending:
+            future.result()
+        self.pool.shutdown()
+        if self.writer is not None: self.writer.close()
@@ -1,22 +1,106 @@
-import re
+import os
 import vtk
 import webcolors
-import matplotlib
 import numpy as np
-from tqdm import tqdm
 import nibabel as nib
+from dive import profiler
 from fury import actor,utils
-from tslearn.metrics import dtw_path
-from scipy.ndimage import gaussian_filter
-from dipy.tracking.streamline import length
 # from dipy.io.streamline import load_tractogram
-from dipy.segment.clustering import QuickBundles
+from vtk.util import numpy_support
 from vtkmodules.vtkRenderingCore import vtkProperty
-from dipy.segment.featurespeed import ResampleFeature
-from dipy.segment.metric import AveragePointwiseEuclideanMetric
-from dipy.tracking.streamline import length, transform_streamlines
+## dipy, tslearn, scipy, tqdm and matplotlib are imported by the functions using them,
+## so the CLI does not pay for them on the paths that do not segment or color
 
 
+def colors_to_lut(colors,lut=None,outside=(0.0,0.0,0.0)):
+    """
+    Writes label colors into a VTK lookup table indexed by label: entry 0 holds the
+    color of points outside every label and entry i the color of the i-th label.
+    Args:
+        colors: array (number of labels, 3) of RGB values in [0, 1]
+        lut: existing vtkLookupTable to update in place, a new one is created if None
+        outside: RGB color of label 0
+    Returns:
+        lut: the updated vtkLookupTable
+    """
+    colors = np.asarray(colors,dtype=float)[:, :3]
+    table = np.ones((len(colors)+1, 4))
+    table[0,:3] = outside
+    table[1:,:3] = colors
+    if lut is None: lut = vtk.vtkLookupTable()
+    lut.SetTable(numpy_support.numpy_to_vtk(np.round(table*255).astype(np.uint8),deep=True))
+    ## Center every entry on its integer label
+    lut.SetTableRange(-0.5, len(table)-0.5)
+    return lut
+
+def map_actor_through_lut(actor_,labels,lut,name='labels'):
+    """
+    Attaches a label per point to the actor's polydata and colors it through the
+    lookup table, so recoloring only needs a table update.
+    Args:
+        actor_: vtkActor with a polydata mapper
+        labels: one label per point, or a single label for the whole actor
+        lut: vtkLookupTable built with colors_to_lut
+    Returns:
+        actor_: the same actor
+    """
+    mapper = actor_.GetMapper()
+    mapper.Update()
+    polydata = vtk.vtkPolyData()
+    polydata.ShallowCopy(mapper.GetInput())
+    labels = np.broadcast_to(np.asarray(labels,dtype=np.float32),(polydata.GetNumberOfPoints(),))
+    label_array = numpy_support.numpy_to_vtk(np.ascontiguousarray(labels),deep=True)
+    label_array.SetName(name)
+    polydata.GetPointData().AddArray(label_array)
+    mapper.SetInputData(polydata)
+    mapper.ScalarVisibilityOn()
+    mapper.SetScalarModeToUsePointFieldData()
+    mapper.SelectColorArray(name)
+    mapper.SetColorModeToMapScalars()
+    mapper.SetLookupTable(lut)
+    mapper.UseLookupTableScalarRangeOn()
+    return actor_
+
+def actor_cost(actor_):
+    """
+    Estimates the rendering cost of an actor, summing the parts of assemblies.
+    Args:
+        actor_: vtkActor, vtkAssembly or image slice actor
+    Returns:
+        cost: dict with the number of points, cells and triangles, the CPU memory of
+        the data (MB) and an estimate of the GPU buffers (MB)
+    """
+    cost = {'points': 0, 'cells': 0, 'triangles': 0, 'cpu_mb': 0.0, 'gpu_mb': 0.0}
+    if isinstance(actor_, vtk.vtkAssembly):
+        parts = actor_.GetParts()
+        for i in range(parts.GetNumberOfItems()):
+            for key, value in actor_cost(parts.GetItemAsObject(i)).items():
+                cost[key] += value
+        return cost
+    if hasattr(actor_, 'GetMapper') and actor_.GetMapper() is not None:
+        data = actor_.GetMapper().GetInput()
+    elif hasattr(actor_, 'GetInput'):
+        data = actor_.GetInput()
+    else:
+        return cost
+    if data is None: return cost
+    cost['points'] = data.GetNumberOfPoints()
+    cost['cells'] = data.GetNumberOfCells()
+    cost['cpu_mb'] = data.GetActualMemorySize() / 1024.0
+    if isinstance(data, vtk.vtkPolyData):
+        polys = data.GetPolys()
+        ## Triangles of a polygon with n points are n-2
+        cost['triangles'] = polys.GetNumberOfConnectivityIds() - 2 * polys.GetNumberOfCells()
+        bytes_per_point = 12
+        if data.GetPointData().GetNormals() is not None: bytes_per_point += 12
+        if data.GetPointData().GetScalars() is not None or actor_.GetMapper().GetScalarVisibility(): bytes_per_point += 4
+        indices = sum(cells.GetNumberOfConnectivityIds() for cells in (data.GetVerts(), data.GetLines(), polys, data.GetStrips()))
+        cost['gpu_mb'] = (cost['points'] * bytes_per_point + indices * 4) / 1024.0**2
+    else:
+        ## Image slices are uploaded as textures of the displayed slice only
+        cost['gpu_mb'] = cost['cpu_mb'] / max(data.GetDimensions())
+    return cost
+
 class load_3dbrain:
     def __init__(self,nifti) -> None:
         self.data = nifti.get_fdata()
@@ -26,6 +110,7 @@ class load_3dbrain:
         self.glass_brain_actor = actor
 
     def loading(self):
+        from scipy.ndimage import gaussian_filter
         self.data[self.data<self.threshold] = 0
         smooth_data = gaussian_filter(self.data,sigma=self.sigma)
         self.glass_brain_actor = actor.contour_from_roi(self.data,affine = self.affine,color=[0,0,0],opacity=0.04)      # 0.08
@@ -33,12 +118,28 @@ class load_3dbrain:
         return self.glass_brain_actor
 
 class load_2dbrain:
-    def __init__(self,nifti) -> None:
-        self.data = nifti.get_fdata()
+    def __init__(self,nifti,max_samples=1000000) -> None:
+        ## Read straight into float32: the slicer does not need float64 precision
+        self.data = np.asanyarray(nifti.dataobj,dtype=np.float32)
         self.affine = nifti.affine
-        self.mean, self.std = self.data[self.data > 0].mean(), self.data[self.data > 0].std()
+        self.max_samples = max_samples
+        self.mean, self.std = self.sample_stats()
         self.value_range = (self.mean - 0.1* self.std, self.mean + 3 * self.std)
 
+    def sample_stats(self):
+        """
+        Estimates the mean and standard deviation of the nonzero voxels from a
+        strided sample of the volume instead of a masked copy of every voxel.
+        Returns:
+            mean, std: statistics of the sampled nonzero intensities
+        """
+        step = max(1, int(np.ceil(self.data.size / self.max_samples)))
+        sample = self.data.ravel(order='K')[::step]
+        sample = sample[sample > 0].astype(np.float64)
+        if sample.size == 0:
+            return 0.0, 0.0
+        return sample.mean(), sample.std()
+
     def load_actor(self):
         slice_actor = actor.slicer(self.data,affine = self.affine,value_range=self.value_range,opacity=0.9)
         return slice_actor
@@ -108,6 +209,8 @@ class Colors:
         return list_of_lists
     
     def get_tab20_color(index,type_):
+        import matplotlib.cm
+        import matplotlib.colors
         if type_=='vol':
             tab20_colors = matplotlib.cm.get_cmap('tab20')
         else:
@@ -116,26 +219,62 @@ class Colors:
         return matplotlib.colors.to_rgb(tab20_colors(index))
 
     def load_colors(self,colors_path=None):
-        dic_colors = {}
+        """
+        Args:
+            colors_path: path to a FreeSurfer style color table
+        Returns:
+            dic_colors: dict mapping each ROI name to its RGB color in [0, 1]
+        """
         if colors_path==None: return
-        with open(colors_path) as colors_file:
-            lines = [line.rstrip() for line in colors_file if not line.rstrip().startswith('#')]
-        for i in lines:
-            match = re.search(r'[a-zA-Z]', i)
-            first_alphabet_index = match.start() if match else None
-            # Find the index of the last alphabetic character
-            last_alphabet_index = None
-            for match in re.finditer(r'[a-zA-Z]', i):
-                last_alphabet_index = match.start()
-            
-            key = str(i[first_alphabet_index:last_alphabet_index+1])
-            colors_str = i[last_alphabet_index+2:]
-            colors_list = colors_str.split()
-            colors_list = list(map(int, colors_list))
-            rgb_tuple = colors_list[0:-1]
-            rgb_decimal_tuple = tuple(component / 255.0 for component in rgb_tuple)
-            dic_colors[key] = rgb_decimal_tuple
-        return dic_colors
+        table, names = load_color_table(colors_path)
+        return {name: tuple(table[label,:3]) for name, label in names.items()}
+
+    def colors_for_labels(self,colors_path,labels):
+        """
+        Maps label ids (e.g. the labels of a mask volume) to their colors with a single
+        array index. Labels missing from the table get the color of label 0.
+        Args:
+            colors_path: path to a FreeSurfer style color table
+            labels: array of label ids of any shape
+        Returns:
+            colors: array (*labels.shape, 3) of RGB colors in [0, 1]
+        """
+        table, _ = load_color_table(colors_path)
+        labels = np.asarray(labels).astype(int)
+        labels = np.where((labels >= 0) & (labels < len(table)), labels, 0)
+        return table[labels,:3]
+
+## Parsed color tables, keyed by (path, modification time)
+color_table_cache = {}
+
+def load_color_table(colors_path):
+    """
+    Parses a FreeSurfer style color table where every non-comment line is
+    "label_id name R G B A". Parsed tables are cached per path and modification time.
+    Args:
+        colors_path: path to the color table
+    Returns:
+        table: float array (max label id + 1, 4) of RGBA values in [0, 1] indexed by label id
+        names: dict mapping each ROI name to its label id
+    """
+    key = (os.path.abspath(colors_path), os.stat(colors_path).st_mtime_ns)
+    if key in color_table_cache: return color_table_cache[key]
+    ids, rgba, names = [], [], {}
+    with open(colors_path) as colors_file:
+        for line in colors_file:
+            fields = line.split()
+            if len(fields) < 5 or fields[0].startswith('#'): continue
+            label = int(fields[0])
+            ## A negative id would overwrite the last rows of the table
+            if label < 0: raise ValueError(f"{colors_path}: label ids must be >= 0, got {line.strip()!r}")
+            ids.append(label)
+            rgba.append(fields[-4:] if len(fields) >= 6 else fields[-3:] + ['0'])
+            names[" ".join(fields[1:-4] if len(fields) >= 6 else fields[1:-3])] = label
+    ids = np.asarray(ids, dtype=int)
+    table = np.zeros((ids.max()+1 if len(ids) else 1, 4))
+    table[ids] = np.asarray(rgba, dtype=float) / 255.0
+    color_table_cache[key] = (table, names)
+    return table, names
 
 ## The following functions copied from Medial Tractography Analysis (MeTA) repository: https://github.com/bagari/meta
 def reorient_streamlines(m_centroid, s_centroids):
@@ -184,11 +323,17 @@ def perform_dtw(model_bundle, subject_bundle, num_segments, affine=None):
     Returns:
         dict: dictionary containing the corresponding points.
     """
+    from tslearn.metrics import dtw_path
+    from dipy.segment.clustering import QuickBundles
+    from dipy.segment.featurespeed import ResampleFeature
+    from dipy.segment.metric import AveragePointwiseEuclideanMetric
+    from dipy.tracking.streamline import length, transform_streamlines
 
     # reference_image = nib.load(mask_img)
 
     ## Trasform the Template bundle to the subject space world cordinates and then to the subject voxel space cordinates:
     ##load_tractogram(model_bundle, "same", bbox_valid_check=False)
+    stage_token = profiler.start('perform_dtw: model centroid')
     model_streamlines = model_bundle.streamlines
     transformed_model_bundles = transform_streamlines(model_streamlines, np.linalg.inv(affine))
 
@@ -198,6 +343,8 @@ def perform_dtw(model_bundle, subject_bundle, num_segments, affine=None):
     m_centroid = m_qb.cluster(transformed_model_bundles).centroids
     print('Model: Centroid length... ', np.mean([length(streamline) for streamline in m_centroid]))
 
+    profiler.stop(stage_token)
+    stage_token = profiler.start('perform_dtw: subject centroids')
     ## Trasform the Subject bundle to the subject voxel cordinates:
     subject_streamlines = subject_bundle.streamlines
     transformed_subject_bundles = transform_streamlines(subject_streamlines, np.linalg.inv(affine))
@@ -218,6 +365,8 @@ def perform_dtw(model_bundle, subject_bundle, num_segments, affine=None):
     s_centroid = reorient_streamlines(m_centroid, s_centroid)
     centroids = reorient_streamlines(m_centroid, centroids)
 
+    profiler.stop(stage_token)
+    stage_token = profiler.start('perform_dtw: dtw correspondence')
     ## Compute the correspondence between the model and the subject centroids using DTW
     dtw_corres = []
     for idx, (m_centroid, s_centroid) in enumerate(zip(m_centroid, s_centroid)):
@@ -262,6 +411,8 @@ def perform_dtw(model_bundle, subject_bundle, num_segments, affine=None):
             centroid_corres.append(corres[key][t])
         s_corres.append(np.array(centroid_corres))
 
+    profiler.stop(stage_token)
+    stage_token = profiler.start('perform_dtw: filter centroids')
     ## combine correspondences
     combined_corres = dtw_corres + s_corres
 
@@ -316,6 +467,7 @@ def perform_dtw(model_bundle, subject_bundle, num_segments, affine=None):
 
         filtered_arrays.append(np.array(combined_array))
     print("Total number filtered centroids:", len(filtered_arrays))
+    profiler.stop(stage_token)
     return filtered_arrays
 
 
@@ -334,6 +486,8 @@ def segment_bundle(bundle_data, dtw_points_sets, num_segments):
     --------
     segments: A list of labels, where each label corresponds to a segment.
     """
+    from tqdm import tqdm
+    stage_token = profiler.start('segment_bundle: planes', segments=num_segments)
     segments = [np.zeros_like(bundle_data, dtype=bool) for _ in range(num_segments+1)]
 
     for dtw_points in tqdm(dtw_points_sets):
@@ -370,6 +524,8 @@ def segment_bundle(bundle_data, dtw_points_sets, num_segments):
                     if np.dot(point - dtw_points[i], plane_normal) >= 0:
                         segments[i+1][x, y, z] = True
 
+    profiler.stop(stage_token)
+    stage_token = profiler.start('segment_bundle: overlapping voxels')
     ######## catching remaining voxels ########
     arrays = np.array(segments)
     sum_array = np.sum(arrays, axis=0)
@@ -389,9 +545,11 @@ def segment_bundle(bundle_data, dtw_points_sets, num_segments):
                         closest_segment_idx = i
             if closest_segment_idx is not None:
                 segments[closest_segment_idx][x, y, z] = True
+    profiler.stop(stage_token)
     return segments
 
 def create_mask_from_trk(streams, shape):
+    from dipy.tracking.streamline import transform_streamlines
     # Load TRK file
     # streams, header = trackvis.read(trk_file)
 
@@ -409,9 +567,8 @@ def create_mask_from_trk(streams, shape):
                 mask[x, y, z] = 1  # Mark this voxel in the mask
     return mask
 
-from dipy.tracking import utils
-
 def bundle_density(streams,ref_shape,ref_affine):
+    from dipy.tracking import utils
 
     streamlines = streams.streamlines
     
@@ -0,0 +1,186 @@
+import os
+import atexit
+import shutil
+import tempfile
+import vtk
+from functools import partial
+from collections import OrderedDict
+from dive.helper import actor_cost
+
+## ROI kinds whose actors are plain polydata and can be written to the cache when released,
+## line actors (tracts) keep fury shaders and are rebuilt from their file instead
+CACHE_KINDS = ('Mask', 'Mesh')
+
+
+def part_state(part):
+    """
+    Returns: dict with what is needed to rebuild a polydata actor around new data (property,
+    transform and mapper coloring)
+    """
+    mapper = part.GetMapper()
+    matrix = vtk.vtkMatrix4x4()
+    matrix.DeepCopy(part.GetMatrix())
+    return {'property': part.GetProperty(), 'matrix': matrix, 'scalar_visibility': mapper.GetScalarVisibility(),
+            'scalar_mode': mapper.GetScalarMode(), 'color_mode': mapper.GetColorMode(), 'array': mapper.GetArrayName(),
+            'lut': mapper.GetLookupTable(), 'use_lut_range': mapper.GetUseLookupTableScalarRange(), 'scalar_range': mapper.GetScalarRange()}
+
+
+def actor_from_state(polydata, state):
+    mapper = vtk.vtkPolyDataMapper()
+    mapper.SetInputData(polydata)
+    mapper.SetScalarVisibility(state['scalar_visibility'])
+    mapper.SetScalarMode(state['scalar_mode'])
+    mapper.SetColorMode(state['color_mode'])
+    if state['array']: mapper.SelectColorArray(state['array'])
+    mapper.SetLookupTable(state['lut'])
+    mapper.SetUseLookupTableScalarRange(state['use_lut_range'])
+    mapper.SetScalarRange(state['scalar_range'])
+    part = vtk.vtkActor()
+    part.SetMapper(mapper)
+    part.SetProperty(state['property'])
+    part.SetUserMatrix(state['matrix'])
+    return part
+
+
+def identity(roi):
+    return roi
+
+
+def actor_from_cache(cache):
+    """
+    Args:
+        cache: (list of (file, part state), assembly matrix or None) from RoiLifecycle.write_cache
+    Returns: the actor read back from the cache files
+    """
+    cached, matrix = cache
+    parts = []
+    for path, state in cached:
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(path)
+        reader.Update()
+        parts.append(actor_from_state(reader.GetOutput(), state))
+    if matrix is None: return parts[0]
+    roi = vtk.vtkAssembly()
+    for part in parts:
+        roi.AddPart(part)
+    roi.SetUserMatrix(matrix)
+    return roi
+
+
+class RoiLifecycle:
+    """
+    Keeps track of how every ROI of the viewer was built, so hidden or removed ROIs can be
+    released under a memory cap (least recently hidden first) and rebuilt when shown again.
+    Masks and meshes are written to a polydata cache when released, tracts are rebuilt from
+    their file with the recorded parameters. ROIs that can be neither stay in memory.
+    """
+
+    def __init__(self, rois, memory_cap_mb=1024, cache_dir=None):
+        """
+        Args:
+            rois: dict of ROI name to actor shared with the viewer, released ROIs are removed from it
+            memory_cap_mb: memory (MB) the hidden ROIs may keep before being released
+            cache_dir: folder for the released polydata, a temporary folder removed at exit if None
+        """
+        self.rois = rois
+        self.memory_cap_mb = memory_cap_mb
+        self.cache_dir = cache_dir
+        self.entries = {}
+        self.hidden = OrderedDict()
+        self.cached_files = 0
+
+    def register(self, name, kind, source=None, builder=None):
+        """
+        Args:
+            name: ROI name (key of rois)
+            kind: 'Mask', 'Tract', 'Mesh' or 'Brain'
+            source: path of the file the ROI was built from
+            builder: callable returning a new actor for the ROI, None if it cannot be rebuilt
+        """
+        self.entries[name] = {'kind': kind, 'source': os.path.abspath(source) if source else None,
+                              'builder': builder, 'cache': None, 'cost_mb': 0.0}
+
+    def hide(self, name, scene):
+        """
+        Removes the ROI from the scene and releases the least recently hidden ROIs while the
+        hidden ones use more than the memory cap.
+        """
+        roi = self.rois.get(name)
+        if roi is not None: scene.rm(roi)
+        if roi is None or name not in self.entries: return
+        self.entries[name]['cost_mb'] = actor_cost(roi)['cpu_mb']
+        self.hidden[name] = True
+        self.hidden.move_to_end(name)
+        for oldest in list(self.hidden):
+            if self.resident_mb() <= self.memory_cap_mb: break
+            self.release(oldest)
+
+    def resident_mb(self):
+        return sum(self.entries[name]['cost_mb'] for name in self.hidden if name in self.rois)
+
+    def release(self, name):
+        """
+        Drops the viewer's reference to a hidden ROI, after writing it to the cache when possible.
+        """
+        entry, roi = self.entries[name], self.rois.get(name)
+        if roi is None: return
+        if entry['kind'] in CACHE_KINDS and entry['cache'] is None:
+            entry['cache'] = self.write_cache(roi)
+        if entry['cache'] is None and entry['builder'] is None: return
+        del self.rois[name]
+        print(f"Released {name} ({entry['cost_mb']:.1f} MB)")
+
+    def write_cache(self, roi):
+        """
+        Returns: (list of (file, part state), assembly matrix or None) or None when the actor is not plain polydata
+        """
+        if isinstance(roi, vtk.vtkAssembly):
+            parts = [roi.GetParts().GetItemAsObject(i) for i in range(roi.GetParts().GetNumberOfItems())]
+            matrix = vtk.vtkMatrix4x4()
+            matrix.DeepCopy(roi.GetMatrix())
+        else:
+            parts, matrix = [roi], None
+        if not all(isinstance(part, vtk.vtkActor) and isinstance(part.GetMapper(), vtk.vtkPolyDataMapper) for part in parts):
+            return None
+        if self.cache_dir is None:
+            self.cache_dir = tempfile.mkdtemp(prefix='dive_cache_')
+            atexit.register(shutil.rmtree, self.cache_dir, True)
+        cached = []
+        for part in parts:
+            path = os.path.join(self.cache_dir, f"{self.cached_files}.vtp")
+            self.cached_files += 1
+            writer = vtk.vtkXMLPolyDataWriter()
+            writer.SetFileName(path)
+            writer.SetInputData(part.GetMapper().GetInput())
+            writer.SetDataModeToBinary()
+            writer.Write()
+            cached.append((path, part_state(part)))
+        return cached, matrix
+
+    def restore_job(self, name):
+        """
+        Returns: callable returning the actor of a registered ROI, from memory, the cache or
+        its source file. It only uses what is captured now (the actor, cache files or builder),
+        so it can run on another thread while this object keeps changing on the main thread.
+        """
+        if name in self.rois: return partial(identity, self.rois[name])
+        entry = self.entries[name]
+        if entry['cache'] is None: return entry['builder']
+        return partial(actor_from_cache, entry['cache'])
+
+    def hidden_source(self, path):
+        """
+        Returns: name of the hidden ROI built from path, None if there is none
+        """
+        path = os.path.abspath(path)
+        for name in self.hidden:
+            if self.entries[name]['source'] == path:
+                return name
+        return None
+
+    def shown(self, name, roi):
+        """
+        Records that a ROI is back in the scene.
+        """
+        self.rois[name] = roi
+        self.hidden.pop(name, None)
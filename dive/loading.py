@@ -7,7 +7,6 @@ from dive.mask import Mask
 import nibabel as nib
 from dive.tract import Tract
 from dive.helper import  Colors
-import trx.trx_file_memmap as tmm
 
 class load:
     def __init__(self):
@@ -16,6 +15,7 @@ class load:
         self.distinctpy_colormask = None
         self.mask = None
 
+    @staticmethod
     def read_from_compressed(file = None):
         """
         Args:
@@ -64,7 +64,7 @@ class load:
                 else:
                     if color_map!=None: 
                         name = mask_args.split('/')[-1].split('.')[0]
-                        dic_colors = Colors.load_colors()
+                        dic_colors = Colors().load_colors(color_map)
                         if name in dic_colors:
                             mask_caller = Mask(mask,dic_colors[name])
                             actor_mask = mask_caller.one_label()
@@ -79,6 +79,7 @@ class load:
             if str(tract_args).split('.')[-1] == 'gz' or str(tract_args).split('.')[-1] == 'zip':
                 tract_image =  nib.streamlines.load(self.read_from_compressed(tract_args))
             elif str(tract_args).split('.')[-1] == 'trx':
+                    import trx.trx_file_memmap as tmm
                     tract_image =  tmm.load(tract_args)
                     tract_image.streamlines._data = tract_image.streamlines._data.astype(np.float32)
             else: tract_image = nib.streamlines.load(tract_args)
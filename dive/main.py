@@ -1,25 +1,34 @@
 import io
+import os
+import copy
 import sys
 import gzip
 import json
 import random
 import zipfile
 import argparse
-import distinctipy
-import numpy as np
-import pyvista as pv
-import nibabel as nib
-from dive.mask import Mask
-from dive.tract import Tract
-from dive.showman import Show
-import trx.trx_file_memmap as tmm
-from dive.csv_tocolors import Colors_csv
-from nibabel.streamlines import ArraySequence
-from dive.helper import load_3dbrain, load_2dbrain, Colors, Mesh
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from dive import profiler
+## Everything else is imported by run_main once the arguments are parsed, so `dive --help`
+## and argument errors do not wait for vtk, fury and the other scientific packages
 random.seed(1)
 
+## --segmentation_method names (case-insensitive) and the matching Tract.tracts_paint method
+SEGMENTATION_METHODS = {'meta':'Meta','centerline':'Center','center':'Center','arclength':'ArcLength'}
+
 
 def run_main():
+    ## dive batch manifest.csv renders many subjects in one process
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        from dive.batch import run_batch
+        run_batch(sys.argv[2:])
+        return
+    ## dive serve answers render requests from a long-running process with warm templates
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from dive.serve import run_serve
+        run_serve(sys.argv[2:])
+        return
     formatter = argparse.ArgumentDefaultsHelpFormatter
     parser = argparse.ArgumentParser(description='Diffusion Visualization Analytics (diVE)', formatter_class=formatter)
     parser.add_argument('--mesh', nargs='+', help='Single or Multple VTK files')
@@ -29,7 +38,7 @@ def run_main():
     parser.add_argument('--background', type=int, default=0, help='Choice either black or white Background color choice: 0 for black, 1 for white')
     parser.add_argument('--zoom', type=float, default=0.5, help='Zooming factor for a standard view')
     parser.add_argument('--inter', type=int, default=1, help = 'Enable interactive mode (1) or save screenshots directly (0)')
-    parser.add_argument('--stats_csv',type=str,help='Path to a CSV file for mask visualization')
+    parser.add_argument('--stats_csv',type=str,help='Path to a stats file (CSV, Feather, Parquet, NPY or NPZ) for mask visualization')
     parser.add_argument('--threshold',type=float,default=0.05, help='Threshold value for visualization')
     parser.add_argument('--log_p_value', type=bool, default=False, help='Use logarithmic p-values (True/False)')
     parser.add_argument('--range_value', nargs=2, type=float, default=None, help='Minimum and maximum values for the value range')
@@ -38,17 +47,47 @@ def run_main():
     parser.add_argument('--colors_mask', type=str, help='List of colors for masks')
     parser.add_argument('--colors_mesh', type=str, help='List of colors for meshes')
     parser.add_argument('--width_tract', type=int, default=1, help='Specify the width of the streamlines')
+    parser.add_argument('--batch_tracts', action='store_true', help='Draw all the single color bundles (and TRX groups) with one actor, colors and visibility go through a lookup table')
     parser.add_argument('--brain_2d', nargs='+', help='A NIfTI file for a 2D brain image')
     parser.add_argument('--glass_brain', help = 'A NIfTI binary file for a 3D brain visualization.')
     parser.add_argument('--color_map', default=None, help='A text file specifying colors for each ROI')   
-    parser.add_argument('--segmentation_method', type=str, default=False, help="Segmentation method to use (e.g., 'centerline' or 'MeTA').")
+    parser.add_argument('--segmentation_method', type=str, default=False, help="Segmentation method to use: 'centerline', 'MeTA' or 'arclength' (cheap, needs no reference volume).")
     parser.add_argument('--segments', type=str, default=False, help='Number of segments for the segmented streamlines along the length')
     parser.add_argument('--cam_view',default=False,type=str,help='Path to JSON file with view specifications')
+    parser.add_argument('--octree', action='store_true', help='Index TRX files with an octree (saved next to the file) and only load the streamlines in view, updated when the camera stops')
+    parser.add_argument('--clip_box', nargs=6, type=float, default=None, help='xmin ymin zmin xmax ymax zmax (mm): only load the TRX streamlines passing through this box, uses the octree index')
+    parser.add_argument('--max_streamlines', type=int, default=200000, help='Most streamlines drawn from an indexed TRX file, the ones in view are thinned evenly beyond it')
+    parser.add_argument('--roi_query', action='store_true', help="Index the voxels of the plain tracts so a sphere ('o') or box ('b') ROI shows only the streamlines through it, 'x' exports them to TRX")
+    parser.add_argument('--memory_cap', type=float, default=1024, help='Memory (MB) that removed ROIs may keep before they are released and rebuilt when added again')
+    parser.add_argument('--turntable', type=int, default=None, help='Render this many frames of a full turn around the scene offscreen (starting from the camera view)')
+    parser.add_argument('--camera_path', '--camera-path', dest='camera_path', default=None, help='JSON list of key cameras (view names or dicts with position, focal, view_up) to render offscreen')
+    parser.add_argument('--frames', type=int, default=None, help='Number of frames interpolated along --camera_path (one per key camera by default)')
+    parser.add_argument('--frames_dir', default=None, help='Folder of the PNG frames (default <output>_frames)')
+    parser.add_argument('--frame_size', nargs=2, type=int, default=[1920, 1080], help='Width and height of the frames')
+    parser.add_argument('--video', default=None, help='MP4 file to write the frames to instead of PNGs (requires imageio)')
+    parser.add_argument('--fps', type=int, default=30, help='Frame rate of --video')
+    parser.add_argument('--save_scene', '--save-scene', dest='save_scene', default=None, help='Save the built scene (geometry, colors, properties, labels, camera) to this file')
+    parser.add_argument('--load_scene', '--load-scene', dest='load_scene', default=None, help='Open a scene saved with --save_scene instead of loading and processing the input files')
+    parser.add_argument('--load_threads', type=int, default=min(8, (os.cpu_count() or 1) + 4), help='Number of threads reading the files and building the actors (file reads and VTK filters release the GIL), 1 loads them one after another')
+    parser.add_argument('--profile', default=None, help='Path to a JSON file (Chrome trace format) with the wall time, CPU time and peak memory of every loading stage')
+    parser.add_argument('--views', nargs='+', default=None, help="Camera views to save with --inter 0 from one scene build (e.g., 'all' or Sagittal_L Coronal_A Axial), written to <output>_<view>.png")
 
     if len(sys.argv) == 1:
         parser.print_help()
         return
     args = parser.parse_args()
+    if args.profile:
+        profiler.enable()
+    import numpy as np
+    import nibabel as nib
+    from dive.mask import Mask
+    from dive.tract import Tract, arc_length_segments
+    from dive.showman import Show
+    from dive.loading import load
+    from dive.lifecycle import RoiLifecycle
+    from dive.csv_tocolors import Colors_csv
+    from nibabel.streamlines import ArraySequence
+    from dive.helper import load_3dbrain, load_2dbrain, Colors, Mesh, colors_to_lut
     if args.inter == 0:
         interactive = False
     else: interactive = True
@@ -99,8 +138,6 @@ def run_main():
         list_csvs = args.stats_csv.split(',')
 
     num_max = max(len(args.mask), len(args.mesh), len(args.tract))
-    slice_actor = None
-    glass_brain_actor = None
     ui_caller = Show(background=args.background)
     main_scene = ui_caller.define_scene()
     dict_disp = {}
@@ -134,175 +171,329 @@ def run_main():
         print(f"Default camera view: {camera_view}")
 
     rois = {}
-    for i in range(num_max):
-        
-        flag_multiple = 0
-        actor_bundle = actor_vtk = actor_mask = None
-        if args.stats_csv:
-            if args.stats_csv[i]!=None and len(list_csvs)>i:
-                cc = Colors_csv(list_csvs[i])
-                color_map_mask = cc.assign_colors(map=args.map,range_value=args.range_value,log_p_value=args.log_p_value,threshold=args.threshold, output=args.output)
-        
-        ## Load masks
-        if i < len(args.mask) and args.mask[i] is not None:
+    if args.load_scene:
+        from dive.scene_io import load_scene
+        ## Everything comes from the scene file, no input file is processed
+        with profiler.stage('load scene', file=args.load_scene):
+            dict_disp, rois = load_scene(args.load_scene,ui_caller)
+        num_max = 0
+    ## Tracts that can be rebuilt from their file alone: name -> (path, color)
+    tract_sources = {}
+    ## With --batch_tracts the plain bundles are collected and drawn by one actor after the loop
+    tract_batch, batch_colors = None, []
+    if args.batch_tracts:
+        import distinctipy
+        from dive.tract import TractBatch
+        tract_batch = TractBatch(tw=args.width_tract)
+        batch_colors = distinctipy.get_colors(len(args.tract))
+    ## Names of the input files, the TRX groups are appended to dict_disp['Tract'] while building
+    tract_names = list(dict_disp['Tract'])
+
+    ## The functions below run on the loading threads: they read the files and build the actors
+    ## but never touch the scene, the viewer or the shared dicts. They return what the main
+    ## thread adds once every previous object is in the scene.
+    def color_row(i):
+        cc = Colors_csv(list_csvs[i])
+        with profiler.stage('coloring', file=list_csvs[i]):
+            color_map_mask = cc.assign_colors(map=args.map,range_value=args.range_value,log_p_value=args.log_p_value,threshold=args.threshold, output=args.output)
+        ## Lookup table shared by the actors colored from this CSV, updated live from the UI
+        return cc, color_map_mask, colors_to_lut(color_map_mask)
+
+    def build_mask(i, coloring):
+        """
+        Returns: dict with the mask actor (None if no color matched), whether the mask has
+        several labels, the label colors and the image, used by the tract and mesh of the same row
+        """
+        cc, color_map_mask, lut_csv = coloring.result() if coloring is not None else (None, None, None)
+        with profiler.stage('load mask', file=args.mask[i]):
             mask = nib.load(args.mask[i])
+            mask.get_fdata()
 
+        with profiler.stage('np.unique', file=args.mask[i]):
+            mask_labels = np.unique(mask.get_fdata())
+        built = {'actor': None, 'multiple': 0, 'colormask': None, 'mask': mask}
+        with profiler.stage('contour mask', file=args.mask[i], labels=len(mask_labels)):
             ## Load masks with multiple labels
-            if len(np.unique(mask.get_fdata()))>2:
-                flag_multiple = 1
+            if len(mask_labels)>2:
+                built['multiple'] = 1
                 #Load based on stats_csv
                 if (args.stats_csv!=None and len(list_csvs)>i):
-                    mask_caller = Mask(mask,colormap=color_map_mask)
-                    actor_mask,distinctpy_colormask = mask_caller.multi_label()
-                    main_scene.add(actor_mask)
-                    rois[dict_disp['Mask'][i]] = actor_mask
+                    mask_caller = Mask(mask,colormap=color_map_mask,lut=lut_csv)
+                ## Color each label from the color_map table
+                elif args.color_map!=None:
+                    mask_caller = Mask(mask,colormap=colors_caller.colors_for_labels(args.color_map,np.delete(mask_labels,0)))
                 else:
-                    mask_caller = Mask(mask)
-                    actor_mask,distinctpy_colormask = mask_caller.multi_label()
-                    main_scene.add(actor_mask)
-                    rois[dict_disp['Mask'][i]] = actor_mask
+                    ## Seeded per row: the rows run on the pool in any order
+                    mask_caller = Mask(mask,rng=random.Random(i))
+                built['actor'],built['colormask'] = mask_caller.multi_label()
 
             ## Color masks based on --colors_mask are provided
             elif len(mask_color_list)>i:
-                mask_caller = Mask(mask,mask_color_list[i])
-                actor_mask = mask_caller.one_label()
-                main_scene.add(actor_mask)
-                rois[dict_disp['Mask'][i]] = actor_mask
+                built['actor'] = Mask(mask,mask_color_list[i]).one_label()
 
             ## Multiple Colors based on color_map or random
             else:
                 ## Color masks with multiple lables based on the color_map
                 if args.color_map!=None: 
                     name = args.mask[i].split('/')[-1].split('.')[0]
-                    dic_colors = Colors.load_colors()
+                    dic_colors = colors_caller.load_colors(args.color_map)
                     if name in dic_colors:
-                        mask_caller = Mask(mask,mask_color_list[i])
-                        actor_mask = mask_caller.one_label()
-                        main_scene.add(actor_mask)
-                        rois[dict_disp['Mask'][i]] = actor_mask
+                        built['actor'] = Mask(mask,dic_colors[name]).one_label()
                 ## Color masks with multiple lables using random colors
                 else: 
-                    mask_caller = Mask(mask,Colors.get_tab20_color(index = i, type_='vol'))
-                    actor_mask = mask_caller.one_label()
-                    main_scene.add(actor_mask)
-                    rois[dict_disp['Mask'][i]] = actor_mask
-            
-        ## Load tractography files:
-        if i < len(args.tract) and args.tract[i] is not None:
-            ## Load compressed tractography formats (TCK, TRK, etc.)
-            if str(args.tract[i]).split('.')[-1] == 'gz' or str(args.tract[i]).split('.')[-1] == 'zip':
-                tract_image =  nib.streamlines.load(read_from_compressed(args.tract[i]))
-            ## Load TRX file
-
-            if str(args.tract[i]).split('.')[-1] == 'trx':
-                tract_image = tmm.load(args.tract[i])
+                    built['actor'] = Mask(mask,Colors.get_tab20_color(index = i, type_='vol')).one_label()
+        return built
+
+    def build_tract(i, coloring, mask_job):
+        """
+        Returns: dict with the (name, actor) pairs to show, the bundles to add to the batch, the
+        group names of a TRX file and the indexes to register with the viewer
+        """
+        cc, color_map_mask, lut_csv = coloring.result() if coloring is not None else (None, None, None)
+        name = tract_names[i]
+        built = {'actors': [], 'batch': [], 'groups': [], 'source': None, 'indexed': None, 'query': None}
+        stage_token = profiler.start('load tract', file=args.tract[i])
+        indexed_tract = None
+        ## Load compressed tractography formats (TCK, TRK, etc.)
+        if str(args.tract[i]).split('.')[-1] == 'gz' or str(args.tract[i]).split('.')[-1] == 'zip':
+            tract_image =  nib.streamlines.load(read_from_compressed(args.tract[i]))
+        ## Load TRX file
+
+        if str(args.tract[i]).split('.')[-1] == 'trx':
+            import trx.trx_file_memmap as tmm
+            tract_image = tmm.load(args.tract[i])
+            if args.octree or args.clip_box:
+                from dive.spatial import IndexedTract
+                ## Keep the memmap, only the streamlines of the queried region are read
+                indexed_tract = IndexedTract(args.tract[i],tract_image,tw=args.width_tract,max_streamlines=args.max_streamlines,
+                                             color=tract_color_list[i] if len(tract_color_list) > i else None)
+            else:
                 tract_image.streamlines._data = tract_image.streamlines._data.astype(np.float32)
-            ## Load other tractography formats (TCK, TRK, etc.)
-            else: tract_image = nib.streamlines.load(args.tract[i])
+        ## Load other tractography formats (TCK, TRK, etc.)
+        else: tract_image = nib.streamlines.load(args.tract[i])
+        profiler.stop(stage_token)
+        ## The mask of the same row colors the bundle, wait for it only once the file is read
+        mask_built = mask_job.result() if mask_job is not None else {'multiple': 0}
+        stage_token = profiler.start('actor.line', file=args.tract[i])
 
-            ## Used for color N segments of the bundle along its length Based on the csv file (stats_csv) {Not tested/implemented for TRX}
-            if flag_multiple ==1:
-                bundle_caller = Tract(bundle = tract_image.streamlines,tw=args.width_tract)
-                if args.stats_csv!=None and args.stats_csv[i]!=None:
-                    bundle_caller.selt_colormap(instance=color_map_mask)
-                else: 
-                    bundle_caller.selt_colormap(instance=distinctpy_colormask)
-                actor_bundle = bundle_caller.with_colormap(mask=mask)
-                main_scene.add(actor_bundle)
-                rois[dict_disp['Tract'][i]] = actor_bundle
+        if indexed_tract is not None:
+            if args.clip_box:
+                actor_bundle = indexed_tract.box_actor(args.clip_box[:3],args.clip_box[3:])
+            else:
+                actor_bundle = indexed_tract.build_actor(indexed_tract.all_ids())
+            if args.octree:
+                built['indexed'] = indexed_tract
+            built['actors'].append((name,actor_bundle))
 
-            ## Used for color N segments of the bundle along its length {Not tested/implemented for TRX}
-            elif (args.segmentation_method) =="MeTA" or (args.segmentation_method) =="centerline" :
-                
+        ## Used for color N segments of the bundle along its length Based on the csv file (stats_csv) {Not tested/implemented for TRX}
+        elif mask_built['multiple'] ==1:
+            bundle_caller = Tract(bundle = tract_image.streamlines,tw=args.width_tract)
+            if args.stats_csv!=None and args.stats_csv[i]!=None:
+                bundle_caller.selt_colormap(instance=color_map_mask,lut=lut_csv)
+            else: 
+                bundle_caller.selt_colormap(instance=mask_built['colormask'])
+            built['actors'].append((name,bundle_caller.with_colormap(mask=mask_built['mask'])))
+
+        ## Used for color N segments of the bundle along its length {Not tested/implemented for TRX}
+        elif args.segmentation_method and str(args.segmentation_method).lower() in SEGMENTATION_METHODS:
+            segmentation_method = SEGMENTATION_METHODS[str(args.segmentation_method).lower()]
+
+            ## Arc-length segments only need the streamlines (works on TRX memmaps as well)
+            if segmentation_method == "ArcLength":
+                bundle_caller = Tract(bundle = tract_image,tw=args.width_tract)
+            else:
                 if (np.array_equal(tract_image.affine, np.eye(4))): 
                     print("A reference image is needed since the tract you provided has affine with no traslation will use brain_2d file as the affine")
                     aff = nib.load(args.brain_2d[0]).affine
                 else: aff= tract_image.affine
                 
                 bundle_caller = Tract(bundle = tract_image,tw=args.width_tract,bundle_shape = tract_image.header['dimensions'],aff=aff)
-                
-                if args.stats_csv:
-                    color_map_mask_tracts_paint = color_map_mask
-                    bundle_caller.selt_colormap(instance=color_map_mask_tracts_paint)
+            
+            if args.stats_csv:
+                bundle_caller.selt_colormap(instance=color_map_mask,lut=lut_csv)
 
-                actor_bundle = bundle_caller.tracts_paint(method = args.segmentation_method,number_of_streams=int(args.segments))
-                main_scene.add(actor_bundle)
-                rois[dict_disp['Tract'][i]] = actor_bundle 
+            built['actors'].append((name,bundle_caller.tracts_paint(method = segmentation_method,number_of_streams=int(args.segments))))
 
-            elif len(tract_color_list) > i:
-                ## Load bundles with single color if --colors_tract are provided
-                bundle_caller = Tract(bundle = tract_image.streamlines,tw=args.width_tract,color_list=tract_color_list[i])
-                actor_bundle = bundle_caller.single_color()
-                main_scene.add(actor_bundle)
-                rois[dict_disp['Tract'][i]] = actor_bundle 
+        elif tract_batch is not None and (not hasattr(tract_image, 'groups') or len(tract_image.groups) == 0):
+            bundle_color = tract_color_list[i] if len(tract_color_list) > i else batch_colors[i]
+            built['batch'].append((name,tract_image.streamlines,bundle_color))
 
+        elif len(tract_color_list) > i:
+            ## Load bundles with single color if --colors_tract are provided
+            bundle_caller = Tract(bundle = tract_image.streamlines,tw=args.width_tract,color_list=tract_color_list[i])
+            built['actors'].append((name,bundle_caller.single_color()))
+            built['source'] = (args.tract[i],tract_color_list[i])
+
+        else:
+            if not hasattr(tract_image, 'groups') or len(tract_image.groups) == 0:
+                ## Load the bundle with directional color (for TRX with only one bundle, no groups)
+                ## Support other tractography formats
+                bundle_caller = Tract(bundle = tract_image.streamlines,tw=args.width_tract)
+                built['actors'].append((name,bundle_caller.dirrection_color()))
+                built['source'] = (args.tract[i],None)
             else:
-                if not hasattr(tract_image, 'groups') or len(tract_image.groups) == 0:
-                    ## Load the bundle with directional color (for TRX with only one bundle, no groups)
-                    ## Support other tractography formats
-                    bundle_caller = Tract(bundle = tract_image.streamlines,tw=args.width_tract)
-                    actor_bundle = bundle_caller.dirrection_color()
-                    main_scene.add(actor_bundle)
-                    rois[dict_disp['Tract'][i]] = actor_bundle
-                else:
-                    ## Special case for multiple bundles in a TRX file 
-                    if args.stats_csv==None:
-                        color_map_mask = distinctipy.get_colors(len(tract_image.groups))
-
-                    for index, (group_name, group_indices) in enumerate(tract_image.groups.items()):
-                        group_streamlines = ArraySequence([tract_image.streamlines[idx] for idx in group_indices])
-                       # need to test
-                        if args.stats_csv:
-                            color_map_mask = []
-                            color_map_mask[index] = cc.assign_colors_grp(map=args.map,range_value=args.range_value,log_p_value=args.log_p_value,threshold=args.threshold, output=args.output,group=1)
-                        group_tract_caller = Tract(bundle = group_streamlines,tw=args.width_tract,color_list=color_map_mask[index])
-                        group_actor_tract = group_tract_caller.single_color()
-                        ## Add the actor to the main scene and rois dictionary
-                        updated_name = f"{dict_disp['Tract'][i]}_{group_name}"
-                        prefix = f"{dict_disp['Tract'][i]}_"
-                        if updated_name.startswith(prefix):
-                            updated_name = updated_name[len(prefix):]
-                        main_scene.add(group_actor_tract)
-                        dict_disp['Tract'].append(updated_name)
-                        rois[updated_name] = group_actor_tract
-                    ## Remove the initial entry of Tract if there are multiple groups
-                    if len(tract_image.groups) > 0 and len(dict_disp['Tract']) > len(tract_image.groups):
-                        dict_disp['Tract'].pop(i)
-
-        ## Load Mesh files:
-        if i < len(args.mesh) and args.mesh[i] is not None:
-            if flag_multiple==1:
-                mesh_caller = Mesh(pv.PolyData(args.mesh[i]))
-                actor_vtk = mesh_caller.load_mesh_with_colors(mask = mask,color_map = distinctpy_colormask)
-                main_scene.add(actor_vtk)
-                rois[dict_disp['Mesh'][i]] = actor_vtk
+                ## Special case for multiple bundles in a TRX file 
+                import distinctipy
+                group_colors = distinctipy.get_colors(len(tract_image.groups),rng=random.Random(i))
+                ## Color every group from one pass over the stats table, on a copy since the
+                ## table of the row is shared with the viewer sliders and the other rows
+                if args.stats_csv:
+                    colors_grp = copy.copy(cc).assign_colors_grp(map=args.map,range_value=args.range_value,log_p_value=args.log_p_value,threshold=args.threshold, output=args.output)
+
+                for index, (group_name, group_indices) in enumerate(tract_image.groups.items()):
+                    group_streamlines = ArraySequence([tract_image.streamlines[idx] for idx in group_indices])
+                    group_color = group_colors[index]
+                    updated_name = f"{name}_{group_name}"
+                    prefix = f"{name}_"
+                    if updated_name.startswith(prefix):
+                        updated_name = updated_name[len(prefix):]
+                    built['groups'].append(updated_name)
+                    if args.stats_csv and group_name in colors_grp:
+                        label_colors = colors_grp[group_name]
+                        if len(label_colors) > 1:
+                            ## One color per label of the group along its length, as the ArcLength
+                            ## segmentation, so the group gets its own actor instead of a batch entry
+                            labels = arc_length_segments(group_streamlines,len(label_colors)) + 1
+                            group_tract_caller = Tract(bundle = group_streamlines,tw=args.width_tract)
+                            built['actors'].append((updated_name,group_tract_caller.paint_labels(group_streamlines,labels,label_colors)))
+                            continue
+                        group_color = tuple(label_colors[0])
+                    if tract_batch is not None:
+                        built['batch'].append((updated_name,group_streamlines,group_color))
+                        continue
+                    group_tract_caller = Tract(bundle = group_streamlines,tw=args.width_tract,color_list=group_color)
+                    built['actors'].append((updated_name,group_tract_caller.single_color()))
+        profiler.stop(stage_token)
+
+        ## Voxel to streamline index of the plain tracts for the ROI queries
+        if args.roi_query and built['source'] is not None:
+            from dive.spatial import StreamlineQuery
+            with profiler.stage('voxel index', file=args.tract[i]):
+                built['query'] = StreamlineQuery(tract_image,tw=args.width_tract,color=built['source'][1],reference=args.brain_2d[0] if args.brain_2d else None)
+        return built
+
+    def build_mesh(i, mask_job):
+        import pyvista as pv
+        with profiler.stage('load mesh', file=args.mesh[i]):
+            polydata = pv.PolyData(args.mesh[i])
+        mask_built = mask_job.result() if mask_job is not None else {'multiple': 0}
+        with profiler.stage('mesh actor', file=args.mesh[i]):
+            if mask_built['multiple']==1:
+                mesh_caller = Mesh(polydata)
+                return mesh_caller.load_mesh_with_colors(mask = mask_built['mask'],color_map = mask_built['colormask'])
+            if args.colors_mesh and args.colors_mesh[i]:
+                mesh_caller = Mesh(polydata,vtk_color_list[i])
             else:
-                if args.colors_mesh and args.colors_mesh[i]:
-                    mesh_caller = Mesh(pv.PolyData(args.mesh[i]),vtk_color_list[i])
-                else:
-                    mesh_caller = Mesh(pv.PolyData(args.mesh[i]),color_list=Colors.get_tab20_color(index = i, type_='vtk'))
-                actor_vtk = mesh_caller.load_mesh()
-                main_scene.add(actor_vtk)
-                rois[dict_disp['Mesh'][i]] = actor_vtk
+                mesh_caller = Mesh(polydata,color_list=Colors.get_tab20_color(index = i, type_='vtk'))
+            return mesh_caller.load_mesh()
 
-        ## Load 3D glass brain:
-        if args.glass_brain and glass_brain_actor is None:
+    def build_glass_brain():
+        with profiler.stage('load glass brain', file=args.glass_brain):
             glass_brain_caller = load_3dbrain(nib.load(args.glass_brain))
-            glass_brain_actor = glass_brain_caller.loading()
-            main_scene.add(glass_brain_actor)
-            rois[dict_disp['Brain'][i]] = glass_brain_actor
+        with profiler.stage('contour glass brain', file=args.glass_brain):
+            return glass_brain_caller.loading()
 
-        ## Load 2D brain slice:
-        if args.brain_2d and slice_actor is None:
+    def build_slice():
+        with profiler.stage('load 2D brain', file=args.brain_2d[0]):
             caller_2d = load_2dbrain(nib.load(args.brain_2d[0]))
-            slice_actor = caller_2d.load_actor()
-            value_min = min(nib.load(args.brain_2d[0]).get_fdata().shape)
-            ui_caller.define_maxview(value_min,slice_actor = slice_actor)
+        with profiler.stage('slicer 2D brain', file=args.brain_2d[0]):
+            return caller_2d, caller_2d.load_actor()
+
+    ## Every file is read and turned into an actor on the pool, a job only waits for the jobs of
+    ## its own row it depends on (the CSV coloring, the multi-label mask). Those are submitted
+    ## first, so a waiting job never holds a worker another job it needs is queued behind.
+    loading = ThreadPoolExecutor(max_workers=max(1, args.load_threads))
+    rows, coloring = [], None
+    for i in range(num_max):
+        new_coloring = None
+        if args.stats_csv:
+            if args.stats_csv[i]!=None and len(list_csvs)>i:
+                coloring = new_coloring = loading.submit(color_row, i)
+        mask_job = loading.submit(build_mask, i, coloring) if i < len(args.mask) and args.mask[i] is not None else None
+        tract_job = loading.submit(build_tract, i, coloring, mask_job) if i < len(args.tract) and args.tract[i] is not None else None
+        mesh_job = loading.submit(build_mesh, i, mask_job) if i < len(args.mesh) and args.mesh[i] is not None else None
+        rows.append((new_coloring, mask_job, tract_job, mesh_job))
+    glass_brain_job = loading.submit(build_glass_brain) if num_max > 0 and args.glass_brain else None
+    slice_job = loading.submit(build_slice) if num_max > 0 and args.brain_2d else None
+
+    ## Objects are added to the scene on the main thread, in the order of the command line
+    for i, (new_coloring, mask_job, tract_job, mesh_job) in enumerate(rows):
+        if new_coloring is not None:
+            cc, color_map_mask, lut_csv = new_coloring.result()
+            ui_caller.add_stats(cc,lut_csv)
+        if mask_job is not None and mask_job.result()['actor'] is not None:
+            main_scene.add(mask_job.result()['actor'])
+            rois[dict_disp['Mask'][i]] = mask_job.result()['actor']
+        if tract_job is not None:
+            built = tract_job.result()
+            for name, actor_bundle in built['actors']:
+                main_scene.add(actor_bundle)
+                rois[name] = actor_bundle
+            for name, streamlines, color in built['batch']:
+                tract_batch.add_bundle(name,streamlines,color)
+            if built['groups']:
+                ## The groups replace the entry of their TRX file
+                dict_disp['Tract'].extend(built['groups'])
+                dict_disp['Tract'].remove(tract_names[i])
+            if built['source'] is not None:
+                tract_sources[tract_names[i]] = built['source']
+            if built['indexed'] is not None:
+                ui_caller.add_indexed(tract_names[i],built['indexed'])
+            if built['query'] is not None:
+                ui_caller.add_queryable(tract_names[i],built['query'])
+        if mesh_job is not None:
+            actor_vtk = mesh_job.result()
+            main_scene.add(actor_vtk)
+            rois[dict_disp['Mesh'][i]] = actor_vtk
+
+        if i == 0 and glass_brain_job is not None:
+            glass_brain_actor = glass_brain_job.result()
+            main_scene.add(glass_brain_actor)
+            rois[dict_disp['Brain'][0]] = glass_brain_actor
+
+        if i == 0 and slice_job is not None:
+            caller_2d, slice_actor = slice_job.result()
+            value_min = min(caller_2d.data.shape)
+            ui_caller.define_maxview(value_min,slice_actor = slice_actor,slice_source=(caller_2d.data,caller_2d.affine,caller_2d.value_range))
             main_scene.add(slice_actor)
-            rois[dict_disp['Brain'][i]] = slice_actor
+            rois[dict_disp['Brain'][-1]] = slice_actor
+    loading.shutdown()
 
+    if tract_batch is not None and tract_batch.names:
+        with profiler.stage('batched actor.line', bundles=len(tract_batch.names)):
+            main_scene.add(tract_batch.build())
+        rois.update(tract_batch.handles())
         
     if args.brain_2d and len(args.brain_2d)>1:
         ui_caller.slice_actorvalues(args.brain_2d[1:])
 
-    ui_caller.Showmanger_init(di=dict_disp,rois=rois,interactive=interactive,camera_view=camera_view,output_path=args.output)
+    if args.save_scene:
+        from dive.scene_io import save_scene
+        with profiler.stage('save scene', file=args.save_scene):
+            save_scene(args.save_scene,ui_caller,dict_disp,rois,view=None if interactive else camera_view)
+
+    ## Masks and meshes are cached when released, plain tracts are rebuilt from their file
+    lifecycle = RoiLifecycle(rois,memory_cap_mb=args.memory_cap)
+    for kind, names, paths in (('Mask',dict_disp['Mask'],args.mask),('Mesh',dict_disp['Mesh'],args.mesh)):
+        for name, path in zip(names,paths):
+            lifecycle.register(name,kind,source=path)
+    for name, (path, color) in tract_sources.items():
+        lifecycle.register(name,'Tract',source=path,builder=partial(load().load_tract,tract_args=path,tract_width=args.width_tract,tract_color=color))
+    ui_caller.set_lifecycle(lifecycle)
+
+    ## Turntable or camera path frames, rendered from this scene build
+    frames = None
+    if args.turntable or args.camera_path:
+        from dive.frames import turntable_cameras, camera_path_cameras
+        if args.camera_path:
+            cameras = camera_path_cameras(args.camera_path,frames=args.frames,views=Show.CAM_SETTINGS)
+        else:
+            start = Show.CAM_SETTINGS.get(camera_view,Show.CAM_SETTINGS['Coronal_A'])
+            cameras = turntable_cameras(args.turntable,start['position'],start['focal'],start['view_up'])
+        frames = {'cameras': cameras, 'output_dir': args.frames_dir or (f"{args.output}_frames" if args.output else 'frames'), 'size': tuple(args.frame_size), 'video': args.video, 'fps': args.fps}
+
+    try:
+        ui_caller.Showmanger_init(di=dict_disp,rois=rois,interactive=interactive,camera_view=camera_view,output_path=args.output,views=args.views,frames=frames)
+    finally:
+        if args.profile:
+            profiler.save(args.profile)
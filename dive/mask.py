@@ -1,19 +1,22 @@
 import vtk
 import random
-import distinctipy
 import numpy as np
 from fury import actor
+from dive.helper import map_actor_through_lut
 
 random.seed(1)
 
 class Mask:
 
-    def __init__(self,mask,color_list=None,colormap=[]):
+    def __init__(self,mask,color_list=None,colormap=[],lut=None,rng=None):
         self.mask = mask
         self.pts = self.mask.get_fdata()
         self.sys_affine = mask.affine
         self.colors = color_list
         self.colormap = colormap
+        self.lut = lut
+        ## random.Random (or seed) for the distinct label colors, the global random state if None
+        self.rng = rng
     
     def one_label(self):
         if (np.delete(np.unique(self.pts), 0)==1):
@@ -32,10 +35,13 @@ class Mask:
         nb_surfaces = len(roi_dict)
         unique_roi_surfaces = vtk.vtkAssembly()
         if len(self.colormap)==0:
-            self.colormap = distinctipy.get_colors(nb_surfaces)
+            import distinctipy
+            self.colormap = distinctipy.get_colors(nb_surfaces,rng=self.rng)
         self.colormap = np.asarray(self.colormap)
         for i, roi in enumerate(roi_dict):
             roi_data = np.isin(self.pts,roi).astype(int)
             roi_surfaces = actor.contour_from_roi(roi_data,affine=self.sys_affine,color=self.colormap[i],opacity=1)
+            if self.lut is not None:
+                map_actor_through_lut(roi_surfaces,i+1,self.lut)
             unique_roi_surfaces.AddPart(roi_surfaces)
         return unique_roi_surfaces,self.colormap
\ No newline at end of file
@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+## Stage timings recorded by run_main when --profile is given, saved as a Chrome trace
+events = []
+enabled = False
+origin = time.perf_counter()
+
+
+def enable():
+    global enabled, origin
+    enabled = True
+    origin = time.perf_counter()
+    del events[:]
+
+
+def peak_rss_mb():
+    """
+    Returns: peak resident memory of the process in MB (0 when it cannot be measured)
+    """
+    if resource is None: return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak / 1024.0**2 if os.uname().sysname == 'Darwin' else peak / 1024.0
+
+
+def start(name, **args):
+    """
+    Starts a stage, returns the token to pass to stop (None when profiling is off).
+    """
+    if not enabled: return None
+    return (name, args, time.perf_counter(), time.thread_time(), peak_rss_mb())
+
+
+def stop(token):
+    """
+    Ends a stage started with start and records its wall time, the CPU time of the calling
+    thread and the peak RSS delta. The peak RSS is process wide: when stages run concurrently
+    (the loading threads of run_main) the delta includes the other threads and is reported as
+    peak_rss_delta_mb_process.
+    """
+    if token is None: return
+    name, args, wall, cpu, rss = token
+    now = time.perf_counter()
+    rss_key = 'peak_rss_delta_mb' if threading.active_count() == 1 else 'peak_rss_delta_mb_process'
+    args = dict(args, cpu_ms=round(1000 * (time.thread_time() - cpu), 3), **{rss_key: round(peak_rss_mb() - rss, 3)})
+    events.append({'name': name, 'ph': 'X', 'ts': round(1e6 * (wall - origin), 1), 'dur': round(1e6 * (now - wall), 1),
+                   'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+
+
+@contextmanager
+def stage(name, **args):
+    token = start(name, **args)
+    try:
+        yield
+    finally:
+        stop(token)
+
+
+def save(path):
+    """
+    Writes the recorded stages to path in Chrome trace format (chrome://tracing, Perfetto).
+    """
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file, indent=1)
+    print(f"Saved profile: {path}")
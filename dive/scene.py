@@ -0,0 +1,228 @@
+import numpy as np
+import nibabel as nib
+from dive.mask import Mask
+from dive.tract import Tract
+from dive.showman import Show
+from fury.io import save_image
+from nibabel.streamlines import ArraySequence
+from dive.helper import load_3dbrain, load_2dbrain, Colors, Mesh
+
+
+def as_streamlines(streamlines):
+    """
+    Args:
+        streamlines: ArraySequence, list of (points, 3) arrays, one (points, 3) array, a
+        (streamlines, points, 3) array, or any object with a streamlines attribute (nibabel
+        Tractogram or TractogramFile, TRX TrxFile, dipy StatefulTractogram)
+    Returns:
+        ArraySequence of float32 streamlines
+    """
+    if hasattr(streamlines, 'streamlines'):
+        streamlines = streamlines.streamlines
+    if isinstance(streamlines, np.ndarray):
+        if streamlines.ndim == 2: streamlines = streamlines[None]
+        if streamlines.ndim != 3 or streamlines.shape[-1] != 3:
+            raise ValueError(f"Streamline arrays must be (points, 3) or (streamlines, points, 3), got {streamlines.shape}")
+        count, points, _ = streamlines.shape
+        packed = ArraySequence()
+        packed._data = np.ascontiguousarray(streamlines.reshape(-1, 3), dtype=np.float32)
+        packed._offsets = np.arange(count, dtype=np.intp) * points
+        packed._lengths = np.full(count, points, dtype=np.intp)
+        return packed
+    if not isinstance(streamlines, ArraySequence):
+        streamlines = ArraySequence(streamlines)
+    if streamlines._data.dtype != np.float32:
+        ## Convert the packed buffer once, the offsets and lengths are kept
+        packed = ArraySequence()
+        packed._data = streamlines._data.astype(np.float32)
+        packed._offsets = streamlines._offsets
+        packed._lengths = streamlines._lengths
+        streamlines = packed
+    return streamlines
+
+
+def as_image(image, affine=None):
+    """
+    Args:
+        image: nibabel image, NIfTI path or 3D numpy array
+        affine: voxel to world transform of a numpy array (identity if None)
+    Returns:
+        nibabel image
+    """
+    if isinstance(image, str):
+        return nib.load(image)
+    if isinstance(image, np.ndarray):
+        return nib.Nifti1Image(image, np.eye(4) if affine is None else np.asarray(affine))
+    return image
+
+
+def as_color(color):
+    """
+    Returns: RGB tuple in [0, 1] of a color name, hex string or RGB sequence, None for None
+    """
+    if color is None: return None
+    if isinstance(color, str):
+        return tuple(Colors().string_to_list(input_string=color)[0])
+    ## numpy arrays and lists become plain tuples, so truth tests like `if self.colors` hold
+    return tuple(float(c) for c in color)
+
+
+class Scene:
+    """
+    Python API of DiVE: builds a scene from in-memory data and renders it offscreen or shows
+    it in the viewer, without going through the command line or temporary files.
+
+    Example:
+        scene = dive.Scene()
+        scene.add_tract(trx.streamlines, color='red')
+        scene.add_mask(atlas_img)
+        scene.add_glass_brain(template_img)
+        scene.render('bundle.png', view='Sagittal_L')
+    """
+
+    def __init__(self, background=0, size=(1000, 1000)):
+        """
+        Args:
+            background: 0 for black, 1 for white
+            size: default (width, height) of the rendered images
+        """
+        self.show = Show(background=background)
+        self.scene = self.show.define_scene()
+        self.size = tuple(size)
+        self.render_window = None
+        ## Names listed in the viewer boxes and the actor of every name
+        self.names = {'Mask': [], 'Tract': [], 'Mesh': [], 'Brain': []}
+        self.rois = {}
+
+    def add(self, kind, name, actor):
+        if name is None:
+            index = len(self.names[kind])
+            while f"{kind.lower()}_{index}" in self.rois: index += 1
+            name = f"{kind.lower()}_{index}"
+        if name in self.rois: raise ValueError(f"The scene already has an object named {name}")
+        self.names[kind].append(name)
+        self.rois[name] = actor
+        self.scene.add(actor)
+        return name
+
+    def add_tract(self, streamlines, color=None, width=1, labels=None, colormap=None, name=None):
+        """
+        Args:
+            streamlines: streamlines in world coordinates, see as_streamlines for the accepted types
+            color: color name, hex string or RGB in [0, 1], colored by direction if None
+            width: width of the streamlines
+            labels: optional label per point (0 for none, i for the i-th colormap row), e.g. along-tract segments
+            colormap: (number of labels, 3) RGB colors of the labels
+            name: name of the tract in the viewer boxes
+        Returns:
+            name: name of the tract
+        """
+        bundle = as_streamlines(streamlines)
+        tract_caller = Tract(bundle = bundle,tw=width,color_list=as_color(color))
+        if labels is not None:
+            if colormap is None: raise ValueError('labels need a colormap')
+            actor_bundle = tract_caller.paint_labels(bundle,np.asarray(labels,dtype=int),colormap)
+        elif color is not None:
+            actor_bundle = tract_caller.single_color()
+        else:
+            actor_bundle = tract_caller.dirrection_color()
+        return self.add('Tract', name, actor_bundle)
+
+    def add_mask(self, mask, affine=None, color=None, colormap=None, name=None):
+        """
+        Args:
+            mask: nibabel image, NIfTI path or 3D label array
+            affine: voxel to world transform of an array mask
+            color: color of a single label mask
+            colormap: (number of labels, 3) RGB colors of a multi-label mask, distinct colors if None
+            name: name of the mask in the viewer boxes
+        Returns:
+            name: name of the mask
+        """
+        mask = as_image(mask, affine)
+        if len(np.unique(mask.get_fdata()))>2:
+            actor_mask,_ = Mask(mask,colormap=[] if colormap is None else colormap).multi_label()
+        else:
+            actor_mask = Mask(mask,as_color(color)).one_label()
+        return self.add('Mask', name, actor_mask)
+
+    def add_mesh(self, mesh, color=None, name=None):
+        """
+        Args:
+            mesh: vtkPolyData (or pyvista mesh) or path of a mesh file read with pyvista
+            color: color of the mesh
+            name: name of the mesh in the viewer boxes
+        Returns:
+            name: name of the mesh
+        """
+        if isinstance(mesh, str):
+            import pyvista as pv
+            mesh = pv.PolyData(mesh)
+        if color is None: color = Colors.get_tab20_color(index = len(self.names['Mesh']), type_='vtk')
+        return self.add('Mesh', name, Mesh(mesh,as_color(color)).load_mesh())
+
+    def add_glass_brain(self, image, affine=None, name=None):
+        """
+        Args:
+            image: nibabel image, NIfTI path or 3D array of the brain drawn as a glass surface
+        Returns:
+            name: name of the brain
+        """
+        return self.add('Brain', name, load_3dbrain(as_image(image, affine)).loading())
+
+    def add_brain_2d(self, image, affine=None, slices=None, name=None):
+        """
+        Args:
+            image: nibabel image, NIfTI path or 3D array shown as slices
+            slices: optional slice values, as the extra values of --brain_2d
+        Returns:
+            name: name of the brain
+        """
+        caller_2d = load_2dbrain(as_image(image, affine))
+        slice_actor = caller_2d.load_actor()
+        self.show.define_maxview(min(caller_2d.data.shape),slice_actor = slice_actor,slice_source=(caller_2d.data,caller_2d.affine,caller_2d.value_range))
+        if slices:
+            self.show.slice_actorvalues([str(v) for v in slices])
+        return self.add('Brain', name, slice_actor)
+
+    def remove(self, name):
+        actor = self.rois.pop(name)
+        self.scene.rm(actor)
+        for names in self.names.values():
+            if name in names: names.remove(name)
+
+    def render(self, path=None, view='Coronal_A', size=None):
+        """
+        Renders the scene offscreen, the window is kept for the next renders.
+        Args:
+            path: PNG file to write, only the image is returned if None
+            view: camera view, one of Show.CAM_SETTINGS
+            size: (width, height) of the image, the scene size if None
+        Returns:
+            image: RGB array (height, width, 3)
+        """
+        if view not in Show.CAM_SETTINGS:
+            raise ValueError(f"Invalid view: {view}. Choose from {list(Show.CAM_SETTINGS.keys())}.")
+        if self.render_window is None:
+            self.render_window = self.show.offscreen_window(size or self.size)
+        self.render_window.SetSize(*(size or self.size))
+        image = self.show.render_view(self.render_window, view)
+        if path: save_image(image, path)
+        return image
+
+    def close(self):
+        """
+        Releases the offscreen window.
+        """
+        if self.render_window is not None:
+            self.render_window.RemoveRenderer(self.scene)
+            self.render_window.Finalize()
+            self.render_window = None
+
+    def interact(self, view='Coronal_A'):
+        """
+        Opens the DiVE viewer on the scene.
+        """
+        self.close()
+        dict_disp = {kind: names if names else [None] for kind, names in self.names.items()}
+        self.show.Showmanger_init(di=dict_disp,rois=self.rois,interactive=True,camera_view=view,output_path=None)
@@ -0,0 +1,267 @@
+import json
+import vtk
+import numpy as np
+from fury import actor
+from vtk.util import numpy_support
+from dive.tract import TractBatch, BundleView
+from dive.helper import map_actor_through_lut
+
+## Format of the scene container written by save_scene
+SCENE_VERSION = 1
+
+
+def polydata_to_array(polydata):
+    """
+    Returns: uint8 array with the polydata as a VTK XML string (base64 binary, all arrays kept)
+    """
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetInputData(polydata)
+    writer.SetDataModeToBinary()
+    writer.SetCompressorTypeToNone()
+    writer.WriteToOutputStringOn()
+    writer.Write()
+    return np.frombuffer(writer.GetOutputString().encode('ascii'), dtype=np.uint8)
+
+
+def array_to_polydata(array):
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.ReadFromInputStringOn()
+    reader.SetInputString(array.tobytes().decode('ascii'))
+    reader.Update()
+    return reader.GetOutput()
+
+
+def property_state(prop):
+    return {'color': prop.GetColor(), 'opacity': prop.GetOpacity(), 'line_width': prop.GetLineWidth(),
+            'point_size': prop.GetPointSize(), 'ambient': prop.GetAmbient(), 'diffuse': prop.GetDiffuse(),
+            'specular': prop.GetSpecular(), 'specular_power': prop.GetSpecularPower(),
+            'interpolation': prop.GetInterpolation(), 'representation': prop.GetRepresentation(),
+            'lighting': prop.GetLighting(), 'backface_culling': prop.GetBackfaceCulling()}
+
+
+def apply_property_state(prop, state):
+    prop.SetColor(state['color'])
+    prop.SetOpacity(state['opacity'])
+    prop.SetLineWidth(state['line_width'])
+    prop.SetPointSize(state['point_size'])
+    prop.SetAmbient(state['ambient'])
+    prop.SetDiffuse(state['diffuse'])
+    prop.SetSpecular(state['specular'])
+    prop.SetSpecularPower(state['specular_power'])
+    prop.SetInterpolation(state['interpolation'])
+    prop.SetRepresentation(state['representation'])
+    prop.SetLighting(state['lighting'])
+    prop.SetBackfaceCulling(state['backface_culling'])
+
+
+def matrix_state(prop):
+    return [prop.GetMatrix().GetElement(i, j) for i in range(4) for j in range(4)]
+
+
+def apply_matrix_state(prop, values):
+    matrix = vtk.vtkMatrix4x4()
+    matrix.DeepCopy(values)
+    prop.SetUserMatrix(matrix)
+
+
+class SceneWriter:
+    """
+    Collects the records of the ROIs and the arrays they refer to, lookup tables shared by
+    several actors are stored once.
+    """
+
+    def __init__(self):
+        self.arrays = {}
+        self.luts = {}
+
+    def add_array(self, array):
+        key = f"a{len(self.arrays)}"
+        self.arrays[key] = array
+        return key
+
+    def add_lut(self, lut):
+        if id(lut) not in self.luts:
+            table = numpy_support.vtk_to_numpy(lut.GetTable()).copy()
+            self.luts[id(lut)] = {'table': self.add_array(table), 'range': lut.GetTableRange()}
+        return self.luts[id(lut)]
+
+    def part(self, part):
+        """
+        Returns: record of a polydata actor, line actors are marked to be rebuilt as fury lines
+        """
+        mapper = part.GetMapper()
+        ## Nothing is rendered yet, actors fed through SetInputConnection (contour_from_roi)
+        ## only hold their polydata once the pipeline is updated
+        mapper.Update()
+        polydata = mapper.GetInput()
+        lines_only = polydata.GetNumberOfLines() > 0 and polydata.GetNumberOfPolys() == 0
+        return {'type': 'line' if lines_only else 'surface', 'data': self.add_array(polydata_to_array(polydata)),
+                'property': property_state(part.GetProperty()), 'matrix': matrix_state(part),
+                'visibility': part.GetVisibility(),
+                'mapper': {'scalar_visibility': mapper.GetScalarVisibility(), 'scalar_mode': mapper.GetScalarMode(),
+                           'color_mode': mapper.GetColorMode(), 'array': mapper.GetArrayName(),
+                           'use_lut_range': mapper.GetUseLookupTableScalarRange(), 'scalar_range': mapper.GetScalarRange(),
+                           'lut': self.add_lut(mapper.GetLookupTable()) if mapper.GetArrayName() == 'labels' else None}}
+
+    def roi(self, roi, show, batches):
+        if roi is show.slice_actor and getattr(show, 'slice_source', None) is not None:
+            data, affine, value_range = show.slice_source
+            return {'type': 'slice', 'data': self.add_array(np.asarray(data, dtype=np.float32)), 'affine': self.add_array(np.asarray(affine)),
+                    'value_range': [float(v) for v in value_range], 'opacity': roi.GetProperty().GetOpacity()}
+        if isinstance(roi, BundleView):
+            if id(roi.batch) not in batches:
+                batch = roi.batch
+                batches[id(batch)] = {'names': batch.names, 'colors': batch.colors, 'opacity': batch.opacity,
+                                      'visible': batch.visible, 'actor': self.part(batch.actor), 'tw': batch.tract_width}
+            return {'type': 'bundle', 'batch': str(id(roi.batch)), 'index': roi.index}
+        if isinstance(roi, vtk.vtkAssembly):
+            parts = [roi.GetParts().GetItemAsObject(i) for i in range(roi.GetParts().GetNumberOfItems())]
+            return {'type': 'assembly', 'parts': [self.part(part) for part in parts], 'matrix': matrix_state(roi)}
+        if isinstance(roi, vtk.vtkActor) and isinstance(roi.GetMapper(), vtk.vtkPolyDataMapper):
+            return self.part(roi)
+        return None
+
+
+def view_camera(show, view=None):
+    """
+    Args:
+        show: Show holding the scene
+        view: CAM_SETTINGS view of the saved images, None for the camera reset to the actors
+        as the viewer opens
+    Returns:
+        dict with the position, focal point, view up and view angle of that camera, the camera
+        of the scene is left unchanged
+    """
+    active = show.scene.GetActiveCamera()
+    saved = vtk.vtkCamera()
+    saved.DeepCopy(active)
+    show.scene.ResetCamera()
+    if view in show.CAM_SETTINGS:
+        show.scene.zoom(0.9)
+        show.set_fury_camera(show.scene, view)
+    camera = {'position': active.GetPosition(), 'focal': active.GetFocalPoint(), 'view_up': active.GetViewUp(), 'view_angle': active.GetViewAngle()}
+    active.DeepCopy(saved)
+    return camera
+
+
+def save_scene(path, show, dict_disp, rois, view=None):
+    """
+    Writes the built scene to one container (numpy npz): the final polydata of every ROI with
+    its color arrays, actor properties and lookup tables, the 2D brain volume, the labels of
+    the viewer boxes and the camera. Reopened with load_scene without processing any file.
+    Args:
+        path: output file
+        show: Show holding the scene
+        dict_disp: dict of the names listed in the viewer boxes
+        rois: dict of ROI name to actor
+        view: camera view of the saved images, None for the viewer's starting camera
+    """
+    writer, batches, records = SceneWriter(), {}, {}
+    for name, roi in rois.items():
+        if roi is None: continue
+        record = writer.roi(roi, show, batches)
+        if record is None:
+            print(f"Cannot save {name} in the scene, it is skipped")
+            continue
+        records[name] = record
+    manifest = {'version': SCENE_VERSION, 'dict_disp': dict_disp, 'rois': records, 'batches': batches,
+                'camera': view_camera(show, view),
+                'max_value_view': show.max_value_view, 'brain_2d': show.brain_2d}
+    ## Written through a file object so np.savez keeps the given extension
+    with open(path, 'wb') as scene_file:
+        np.savez(scene_file, manifest=np.frombuffer(json.dumps(manifest).encode('utf-8'), dtype=np.uint8), **writer.arrays)
+    print(f"Saved scene: {path}")
+
+
+def lut_from_state(state, arrays):
+    lut = vtk.vtkLookupTable()
+    lut.SetTable(numpy_support.numpy_to_vtk(np.ascontiguousarray(arrays[state['table']]), deep=True))
+    lut.SetTableRange(*state['range'])
+    return lut
+
+
+def part_from_record(record, arrays, luts):
+    polydata = array_to_polydata(arrays[record['data']])
+    state = record['mapper']
+    if record['type'] == 'line':
+        ## DiVE draws every tract as fury fake tubes, rebuilt from the saved points and colors
+        pts = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+        lines = polydata.GetLines()
+        connectivity = numpy_support.vtk_to_numpy(lines.GetConnectivityArray())
+        offsets = numpy_support.vtk_to_numpy(lines.GetOffsetsArray())
+        streamlines = np.split(pts[connectivity], offsets[1:-1])
+        colors = numpy_support.vtk_to_numpy(polydata.GetPointData().GetScalars())[connectivity, :3] / 255.0
+        part = actor.line(streamlines, colors=colors, lod=False, fake_tube=True, linewidth=record['property']['line_width'])
+        if state['lut'] is not None:
+            key = state['lut']['table']
+            if key not in luts: luts[key] = lut_from_state(state['lut'], arrays)
+            labels = numpy_support.vtk_to_numpy(polydata.GetPointData().GetArray('labels'))[connectivity]
+            map_actor_through_lut(part, labels, luts[key])
+    else:
+        mapper = vtk.vtkPolyDataMapper()
+        mapper.SetInputData(polydata)
+        mapper.SetScalarVisibility(state['scalar_visibility'])
+        mapper.SetScalarMode(state['scalar_mode'])
+        mapper.SetColorMode(state['color_mode'])
+        if state['array']: mapper.SelectColorArray(state['array'])
+        if state['lut'] is not None:
+            key = state['lut']['table']
+            if key not in luts: luts[key] = lut_from_state(state['lut'], arrays)
+            mapper.SetLookupTable(luts[key])
+        mapper.SetUseLookupTableScalarRange(state['use_lut_range'])
+        mapper.SetScalarRange(state['scalar_range'])
+        part = vtk.vtkActor()
+        part.SetMapper(mapper)
+    apply_property_state(part.GetProperty(), record['property'])
+    apply_matrix_state(part, record['matrix'])
+    part.SetVisibility(record['visibility'])
+    return part
+
+
+def load_scene(path, show):
+    """
+    Rebuilds a scene written by save_scene into the scene of show.
+    Args:
+        path: scene file
+        show: Show whose scene (define_scene) receives the actors
+    Returns:
+        dict_disp: dict of the names listed in the viewer boxes
+        rois: dict of ROI name to actor (BundleView for batched bundles)
+    """
+    container = np.load(path)
+    arrays = {key: container[key] for key in container.files}
+    manifest = json.loads(arrays.pop('manifest').tobytes().decode('utf-8'))
+    if manifest['version'] != SCENE_VERSION:
+        raise ValueError(f"Unsupported scene version {manifest['version']} in {path}")
+    luts, batches, rois = {}, {}, {}
+    for key, record in manifest['batches'].items():
+        batch = TractBatch(tw=record['tw'])
+        batch.names, batch.opacity, batch.visible = record['names'], record['opacity'], record['visible']
+        batch.colors = [tuple(color) for color in record['colors']]
+        batch.actor = part_from_record(record['actor'], arrays, luts)
+        batch.lut = batch.actor.GetMapper().GetLookupTable()
+        show.scene.add(batch.actor)
+        batches[key] = batch
+    for name, record in manifest['rois'].items():
+        if record['type'] == 'bundle':
+            rois[name] = BundleView(batches[record['batch']], record['index'])
+            continue
+        if record['type'] == 'slice':
+            data, affine = arrays[record['data']], arrays[record['affine']]
+            roi = actor.slicer(data, affine=affine, value_range=record['value_range'], opacity=0.9)
+            roi.GetProperty().SetOpacity(record['opacity'])
+            show.define_maxview(min(data.shape), slice_actor=roi, slice_source=(data, affine, record['value_range']))
+        elif record['type'] == 'assembly':
+            roi = vtk.vtkAssembly()
+            for part in record['parts']:
+                roi.AddPart(part_from_record(part, arrays, luts))
+            apply_matrix_state(roi, record['matrix'])
+        else:
+            roi = part_from_record(record, arrays, luts)
+        show.scene.add(roi)
+        rois[name] = roi
+    if manifest['brain_2d']: show.slice_actorvalues(manifest['brain_2d'])
+    camera = manifest['camera']
+    show.scene.set_camera(position=camera['position'], focal_point=camera['focal'], view_up=camera['view_up'])
+    show.scene.GetActiveCamera().SetViewAngle(camera['view_angle'])
+    return manifest['dict_disp'], rois
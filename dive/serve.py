@@ -0,0 +1,232 @@
+import json
+import time
+import argparse
+import vtk
+import numpy as np
+import nibabel as nib
+from dive.loading import load
+from dive.showman import Show
+from collections import OrderedDict
+from vtk.util import numpy_support
+from dive.batch import build_subject
+from dive.helper import load_3dbrain, load_2dbrain
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+## Request fields holding paths (list or space separated string) and colors (list or comma
+## separated string), passed to build_subject as the manifest cells of dive batch
+PATH_FIELDS = ('tract', 'mask', 'mesh')
+COLOR_FIELDS = ('colors_tract', 'colors_mask', 'colors_mesh')
+
+
+def png_bytes(image):
+    """
+    Args:
+        image: RGB image (height, width, 3) from Show.grab_image
+    Returns:
+        bytes of the image encoded as PNG, without touching the disk
+    """
+    height, width, _ = image.shape
+    data = vtk.vtkImageData()
+    data.SetDimensions(width, height, 1)
+    ## VTK images start at the bottom row
+    data.GetPointData().SetScalars(numpy_support.numpy_to_vtk(np.ascontiguousarray(np.flipud(image)).reshape(-1, 3), deep=True))
+    writer = vtk.vtkPNGWriter()
+    writer.SetInputData(data)
+    writer.WriteToMemoryOn()
+    writer.Write()
+    return numpy_support.vtk_to_numpy(writer.GetResult()).tobytes()
+
+
+def request_row(request):
+    """
+    Returns: the request as a dive batch manifest row (dict of strings)
+    """
+    row = {}
+    for key, value in request.items():
+        if isinstance(value, (list, tuple)):
+            value = (' ' if key in PATH_FIELDS else ',').join(str(v) for v in value)
+        if key in PATH_FIELDS + COLOR_FIELDS + ('stats_csv',) and value:
+            row[key] = str(value)
+    return row
+
+
+class RenderServer:
+    """
+    Keeps one scene and offscreen window alive across render requests. Templates (glass
+    brains, 2D brains and atlases) are contoured on first use and kept, the least recently
+    used ones are dropped beyond max_templates. Only the subject actors are built per request.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.ui_caller = Show(background=args.background)
+        self.scene = self.ui_caller.define_scene()
+        self.render_window = self.ui_caller.offscreen_window(tuple(args.size))
+        self.templates = OrderedDict()
+        self.shown = []
+        self.renders = 0
+
+    def template(self, kind, path):
+        """
+        Args:
+            kind: 'glass_brain', 'brain_2d' or 'atlas'
+            path: NIfTI file of the template
+        Returns:
+            actor of the template, with the slicer of a 2D brain ((actor, load_2dbrain) for 'brain_2d')
+        """
+        key = (kind, path)
+        if key in self.templates:
+            self.templates.move_to_end(key)
+            return self.templates[key]
+        t0 = time.perf_counter()
+        if kind == 'glass_brain':
+            built = load_3dbrain(nib.load(path)).loading()
+        elif kind == 'brain_2d':
+            caller_2d = load_2dbrain(nib.load(path))
+            built = (caller_2d.load_actor(), caller_2d)
+        else:
+            built = load().load_mask(mask_args = path)
+        print(f"Loaded template {path} in {time.perf_counter() - t0:.2f} s")
+        self.templates[key] = built
+        while len(self.templates) > self.args.max_templates:
+            self.templates.popitem(last=False)
+        return built
+
+    def show_templates(self, request):
+        """
+        Puts the templates of the request (the server defaults when it names none) in the scene.
+        """
+        glass_brain = request.get('glass_brain', self.args.glass_brain)
+        brain_2d = request.get('brain_2d', self.args.brain_2d)
+        if isinstance(brain_2d, str): brain_2d = [brain_2d]
+        atlases = request.get('atlas', self.args.atlas or [])
+        if isinstance(atlases, str): atlases = atlases.split()
+
+        actors = [self.template('atlas', path) for path in atlases]
+        if glass_brain: actors.append(self.template('glass_brain', glass_brain))
+        if brain_2d:
+            slice_actor, caller_2d = self.template('brain_2d', brain_2d[0])
+            self.ui_caller.define_maxview(min(caller_2d.data.shape),slice_actor = slice_actor)
+            if len(brain_2d)>1:
+                self.ui_caller.slice_actorvalues([str(v) for v in brain_2d[1:]])
+            actors.append(slice_actor)
+        actors = [a for a in actors if a is not None]
+        for actor in self.shown:
+            if not any(actor is a for a in actors): self.scene.rm(actor)
+        for actor in actors:
+            if not any(actor is a for a in self.shown): self.scene.add(actor)
+        self.shown = actors
+
+    def render(self, request):
+        """
+        Args:
+            request: dict with any of tract, mask, mesh, stats_csv, colors_tract, colors_mask,
+            colors_mesh (as in a dive batch manifest), view, size, glass_brain, brain_2d, atlas
+        Returns:
+            png: bytes of the rendered image
+            timings: dict with the load and render time
+        """
+        t0 = time.perf_counter()
+        self.show_templates(request)
+        actors = build_subject(request_row(request), self.args)
+        try:
+            self.scene.add(*actors)
+            t1 = time.perf_counter()
+            self.render_window.SetSize(*request.get('size', self.args.size))
+            image = self.ui_caller.render_view(self.render_window, request.get('view', self.args.view))
+            png = png_bytes(image)
+        finally:
+            for subject_actor in actors:
+                self.scene.rm(subject_actor)
+        self.renders += 1
+        return png, {'load_s': round(t1 - t0, 3), 'render_s': round(time.perf_counter() - t1, 3)}
+
+    def status(self):
+        return {'renders': self.renders, 'templates': [path for _, path in self.templates], 'views': list(Show.CAM_SETTINGS.keys())}
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    """
+    POST /render with a JSON body answers the PNG bytes, GET /status the cached templates.
+    Requests are answered one at a time on the thread owning the render window.
+    """
+    server_version = 'DiVE'
+
+    def send_json(self, code, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/status':
+            return self.send_json(404, {'error': f'unknown path {self.path}'})
+        self.send_json(200, self.server.renderer.status())
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/render':
+            return self.send_json(404, {'error': f'unknown path {self.path}'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(request, dict): raise ValueError('the request must be a JSON object')
+            view = request.get('view', self.server.renderer.args.view)
+            if not isinstance(view, str) or view not in Show.CAM_SETTINGS:
+                raise ValueError(f"invalid view {view!r}, choose from {list(Show.CAM_SETTINGS.keys())}")
+        except (ValueError, TypeError, KeyError) as error:
+            return self.send_json(400, {'error': str(error)})
+        try:
+            png, timings = self.server.renderer.render(request)
+        except Exception as error:
+            return self.send_json(500, {'error': str(error)})
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(png)))
+        self.send_header('X-DiVE-Load-Seconds', str(timings['load_s']))
+        self.send_header('X-DiVE-Render-Seconds', str(timings['render_s']))
+        self.end_headers()
+        self.wfile.write(png)
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} {format % args}")
+
+
+def run_serve(argv=None):
+    """
+    Starts the render server on a local port.
+    Args:
+        argv: command line arguments after 'serve'
+    """
+    formatter = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(prog='dive serve', description='Answer JSON render requests with PNG images, keeping the templates loaded', formatter_class=formatter)
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (local only by default)')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--glass_brain', help='A NIfTI binary file for a 3D brain used when a request names no template')
+    parser.add_argument('--brain_2d', nargs='+', help='A NIfTI file for a 2D brain image used when a request names no template')
+    parser.add_argument('--atlas', nargs='+', help='Atlas masks shown when a request names no template')
+    parser.add_argument('--max_templates', type=int, default=8, help='Number of templates kept loaded, the least recently used are dropped')
+    parser.add_argument('--background', type=int, default=0, help='Choice either black or white Background color choice: 0 for black, 1 for white')
+    parser.add_argument('--view', default='Coronal_A', help='Camera view used when the request has none')
+    parser.add_argument('--size', nargs=2, type=int, default=[1000, 1000], help='Width and height of the images when the request has no size')
+    parser.add_argument('--width_tract', type=int, default=1, help='Specify the width of the streamlines')
+    parser.add_argument('--threshold',type=float,default=0.05, help='Threshold value for visualization')
+    parser.add_argument('--log_p_value', type=bool, default=False, help='Use logarithmic p-values (True/False)')
+    parser.add_argument('--range_value', nargs=2, type=float, default=None, help='Minimum and maximum values for the value range')
+    parser.add_argument('--map', help='Colormap name from Matplotlib', type=str, default = 'RdBu')
+    args = parser.parse_args(argv)
+
+    renderer = RenderServer(args)
+    ## Load the default templates before the first request
+    renderer.show_templates({})
+    server = HTTPServer((args.host, args.port), RenderHandler)
+    server.renderer = renderer
+    print(f"DiVE render server on http://{args.host}:{args.port} (POST /render, GET /status)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        renderer.render_window.RemoveRenderer(renderer.scene)
+        renderer.render_window.Finalize()
@@ -1,19 +1,25 @@
 import os
 import re
+import sys
+import time
+import vtk
 import subprocess
 import numpy as np
-import pyvista as pv
-from dive.loading import load
+from dive import profiler
+from dive.tract import BundleView
+from functools import partial
+from dive.lifecycle import RoiLifecycle
 from fury import ui,window
 from numbers import Number
-from dive.helper import Mesh, Colors
+from dive.helper import Mesh, Colors, colors_to_lut, actor_cost
 from collections import OrderedDict
-from dive.csv_tocolors import Colors_csv
 from fury.data import read_viz_icons
+from fury.io import save_image
+from vtk.util import numpy_support
+from concurrent.futures import ThreadPoolExecutor
 from vtkmodules.vtkCommonColor import vtkNamedColors
 from fury.ui.core import UI,Button2D, Disk2D, Rectangle2D, TextBlock2D
 
-selected_item = None
 class Panel2D(UI):
     """A 2D UI Panel.
 
@@ -544,6 +550,9 @@ class ComboBox2D(UI):
         )
 
         self.on_change = lambda ui: None
+        ## Called with the combo box when an item is picked, its element is in selected_item
+        self.selected_item = None
+        self.on_select = lambda combobox: None
 
     def _get_actors(self):
         """Get the actors composing this UI component."""
@@ -662,8 +671,7 @@ class ComboBox2D(UI):
         listboxitem: :class:`ListBoxItem2D`
 
         """
-        global selected_item
-        selected_item = listboxitem.element
+        self.selected_item = listboxitem.element
         truncated_string = listboxitem.element[:15] if len(listboxitem.element) > 15 else listboxitem.element
         self._selection =  self.main_placeholder + truncated_string
         self._selection_ID = self.items.index(listboxitem.element)
@@ -678,6 +686,7 @@ class ComboBox2D(UI):
         else:
             for i in self.others:
                 i.set_visibility(True)
+        self.on_select(self)
         self.on_change(self)
 
         i_ren.force_render()
@@ -1672,9 +1681,11 @@ class Show:
         self.panel.add_element(self.opacity_slider,(0.55,0.3))
 
     
-    def define_maxview(self,maxval=180,slice_actor=None,brain_2d=None):
+    def define_maxview(self,maxval=180,slice_actor=None,brain_2d=None,slice_source=None):
         self.brain_2d = brain_2d
         self.slice_actor = slice_actor
+        ## (volume, affine, value_range) of the slicer, kept for --save_scene
+        self.slice_source = slice_source
         self.max_value_view = maxval
         # print(self.slice_actor.shape,self.brain_2d)
 
@@ -1682,16 +1693,94 @@ class Show:
         self.background = background
         self.scene = None
         self.slice_actor = None
+        self.slice_source = None
         self.brain_2d = None
         self.max_value_view = None
-        global selected_item
-        self.selected_actor = selected_item
+        ## Name of the ROI last picked in any of the combo boxes
+        self.selected_item = None
+        self.selected_actor = None
         self.ori = 1
         self.slider_cut = None
         self.rois = None
-        self.indexxx = 0
+        self.stats = []
+        self.view_angle = None
+        self.pending_cut = None
+        self.perf_visible = False
+        self.frames = 0
+        self.perf_rendering = False
+        self.frame_clock = time.perf_counter()
+        self.dialog = None
+        self.lifecycle = None
+        self.indexed = {}
+        self.queryable = {}
+        self.roi_widget = None
+        self.pending_roi = None
+        self.roi_ids = {}
+        self.roi_actors = {}
+        self.output_path = None
+        self.camera_state = None
+        self.camera_moved = False
+        self.loader = None
+        self.loading = []
+    def add_indexed(self,name,indexed):
+        ## IndexedTract reloaded with the streamlines in view when the camera stops
+        self.indexed[name] = indexed
+
+    def add_queryable(self,name,query):
+        ## StreamlineQuery filtered by the sphere/box ROI widget
+        self.queryable[name] = query
+
+    def set_lifecycle(self,lifecycle):
+        self.lifecycle = lifecycle
+
     def slice_actorvalues(self,val):
         self.brain_2d = val
+
+    def add_stats(self,colors_csv,lut):
+        """
+        Args:
+        colors_csv: Colors_csv - Loaded stats table used to color actors
+        lut: vtkLookupTable - Lookup table of the actors colored from colors_csv
+        Registers a stats table so the threshold and range sliders can recolor its actors
+        """
+        self.stats.append((colors_csv,lut))
+
+    def stats_panel(self):
+        """
+        Builds the panel with the threshold and range sliders of the stats tables
+        Return: the Panel2D of the sliders
+        """
+        p_max = max(float(np.nanmax(cc.df['P_value'])) for cc,_ in self.stats)
+        value_min = min(float(min(cc.data_min,cc.min_value)) for cc,_ in self.stats)
+        value_max = max(float(max(cc.data_max,cc.max_value)) for cc,_ in self.stats)
+        colors_csv = self.stats[0][0]
+        threshold = colors_csv.threshold if colors_csv.threshold is not None else p_max
+        self.threshold_slider_label = self.build_label(text=str("Threshold"))
+        self.threshold_slider = LineSlider2D(min_value=0.0, max_value=max(1.0,p_max), initial_value=threshold, length=100,text_template='{value:.2f}')
+        self.range_slider_label = self.build_label(text=str("Range"))
+        self.range_slider = ui.LineDoubleSlider2D(min_value=value_min, max_value=value_max, initial_values=(colors_csv.min_value,colors_csv.max_value), length=100,text_template='{value:.1f}')
+        self.range_slider.left_disk_text.color = (0, 0, 0)
+        self.range_slider.right_disk_text.color = (0, 0, 0)
+        panel = Panel2D(size=(300, 120), position=(0, 410), color=(0.9, 0.9, 0.9), opacity=1, align='left')
+        panel.add_element(self.threshold_slider_label,(0.1,0.65))
+        panel.add_element(self.threshold_slider,(0.55,0.7))
+        panel.add_element(self.range_slider_label,(0.1,0.2))
+        panel.add_element(self.range_slider,(0.55,0.25))
+        self.threshold_slider.on_change = self.change_threshold
+        self.range_slider.on_change = self.change_range
+        ## Grey the rows above the starting threshold now, not on the first slider move
+        for colors_csv,lut in self.stats:
+            colors_to_lut(colors_csv.recolor(threshold=threshold),lut)
+        return panel
+
+    def change_threshold(self,slider):
+        for colors_csv,lut in self.stats:
+            colors_to_lut(colors_csv.recolor(threshold=slider.value),lut)
+
+    def change_range(self,slider):
+        value_range = (slider.left_disk_value,slider.right_disk_value)
+        for colors_csv,lut in self.stats:
+            colors_to_lut(colors_csv.recolor(range_value=value_range),lut)
     def change_view(self,radio):
         """
         Args: 
@@ -1707,63 +1796,69 @@ class Show:
         if self.ori==1:
             self.scene.set_camera(position=(400, 0, 0), focal_point=(0, 0, 0), view_up=(0, 0, 1))
             if self.slice_actor:
-                self.scene.rm(self.slice_actor)
                 if self.slider_cut==None:
                     cut = int(self.brain_2d[0]) if self.brain_2d!=None else self.slice_actor.shape[0] // 2
                 else: cut = self.slider_cut
-                self.slice_actor.display(x=cut, y=None, z=None)
-                self.scene.add(self.slice_actor)
+                self.display_cut(cut)
         if self.ori==2:
             self.scene.set_camera(position=(0, 0, -400), focal_point=(0, 0, 0), view_up=(0, 1, 0))
             if self.slice_actor:
-                self.scene.rm(self.slice_actor)
                 if self.slider_cut==None:
                     cut = int(self.brain_2d[2]) if self.brain_2d!=None else self.slice_actor.shape[2] // 2
                 else:  cut = self.slider_cut 
-                self.slice_actor.display(x=None,y=None,z=cut)
-                self.scene.add(self.slice_actor)
+                self.display_cut(cut)
         if self.ori==3:
             self.scene.set_camera(position=(0, 400, 0), focal_point=(0, 0, 0), view_up=(0, 0, 1))
             if self.slice_actor:
-                self.scene.rm(self.slice_actor)
                 if self.slider_cut==None:
                     cut = int(self.brain_2d[1]) if self.brain_2d!=None else self.slice_actor.shape[1] // 2
                 else: cut = self.slider_cut
-                self.slice_actor.display(x=None,y=cut, z=None)
-                self.scene.add(self.slice_actor)
+                self.display_cut(cut)
+
+    def display_cut(self,cut):
+        """
+        Args:
+        cut: int - Index of the slice along the current orientation
+        Updates the slice actor in place, without removing it from the scene
+        """
+        if self.ori==1:
+            self.slice_actor.display(x=cut,y=None,z=None)
+        elif self.ori==2:
+            self.slice_actor.display(x=None,y=None,z=cut)
+        elif self.ori==3:
+            self.slice_actor.display(x=None,y=cut,z=None)
+
+    EYE_SCALE = 400
+    CAM_SETTINGS = {
+        'Sagittal_L': {'position': (-EYE_SCALE, 0, 0), 'focal': (0, 0, 0), 'view_up': (0, 0, 1)},
+        'Sagittal_R': {'position': (EYE_SCALE, 0, 0), 'focal': (0, 0, 0), 'view_up': (0, 0, 1)},
+        'Coronal_A': {'position': (0, EYE_SCALE, 0), 'focal': (0, 0, 0), 'view_up': (0, 0, 1)},
+        'Coronal_P': {'position': (0, -EYE_SCALE, 0), 'focal': (0, 0, 0), 'view_up': (0, 0, 1)},
+        'Axial': {'position': (0, 0, EYE_SCALE), 'focal': (0, 0, 0), 'view_up': (0, 1, 0)},
+    }
+
+    ## Minimum time between two slice updates while dragging the slider
+    SLICE_UPDATE_MS = 33
 
     def set_fury_camera(self, scene, view='Axial'):
         """
         apply predefined camera settings to the selected view.
         """
         self.scene.zoom(0.9)
-        EYE_SCALE = 400
-        CAM_SETTINGS = {
-            'Sagittal_L': {'position': (-EYE_SCALE, 0, 0), 'focal': (0, 0, 0), 'view_up': (0, 0, 1)},
-            'Sagittal_R': {'position': (EYE_SCALE, 0, 0), 'focal': (0, 0, 0), 'view_up': (0, 0, 1)},
-            'Coronal_A': {'position': (0, EYE_SCALE, 0), 'focal': (0, 0, 0), 'view_up': (0, 0, 1)},
-            'Coronal_P': {'position': (0, -EYE_SCALE, 0), 'focal': (0, 0, 0), 'view_up': (0, 0, 1)},
-            'Axial': {'position': (0, 0, EYE_SCALE), 'focal': (0, 0, 0), 'view_up': (0, 1, 0)},
-        }
-        if view in CAM_SETTINGS:
-            settings = CAM_SETTINGS[view]
+        if view in self.CAM_SETTINGS:
+            settings = self.CAM_SETTINGS[view]
             scene.set_camera(
                 position=settings['position'],
                 focal_point=settings['focal'],
                 view_up=settings['view_up']
             )
         else:
-            print(f"Invalid view: {view}. Choose from {list(CAM_SETTINGS.keys())}.")
+            print(f"Invalid view: {view}. Choose from {list(self.CAM_SETTINGS.keys())}.")
 
-    def saveresults(self, output_path, view='Coronal_A'):
+    def display_view_slice(self, view):
         """
-        Set camera view in FURY and save results as PNG images.
+        Cut the 2D brain slice that matches the camera view.
         """
-        self.scene.zoom(0.9)
-        # apply the camera settings using the predefined view
-        self.set_fury_camera(self.scene, view)
-
-        ## get the correct slice to display based on the view
         if self.slice_actor:
             if view in ['Sagittal_L', 'Sagittal_R']:
                 cut = int(self.brain_2d[0]) if self.brain_2d is not None else self.slice_actor.shape[0] // 2
@@ -1774,6 +1869,17 @@ class Show:
             elif view in ['Axial']:
                 cut = int(self.brain_2d[2]) if self.brain_2d is not None else self.slice_actor.shape[2] // 2
                 self.slice_actor.display(x=None, y=None, z=cut)
+
+    def saveresults(self, output_path, view='Coronal_A'):
+        """
+        Set camera view in FURY and save results as PNG images.
+        """
+        self.scene.zoom(0.9)
+        # apply the camera settings using the predefined view
+        self.set_fury_camera(self.scene, view)
+
+        ## get the correct slice to display based on the view
+        self.display_view_slice(view)
         
         fname = f"{output_path}"
         # fname = f"{output_path}_{view}.png"
@@ -1781,13 +1887,112 @@ class Show:
         window.record(scene=self.scene, out_path=fname, size=(2000, 2000), reset_camera=False)
         print(f"Saved: {fname}")
 
+    def offscreen_window(self, size=(2000, 2000)):
+        """
+        Args:
+        size: (int, int) - Size of the images
+        Return: an offscreen vtkRenderWindow showing the scene, reused across renders
+        """
+        render_window = vtk.vtkRenderWindow()
+        render_window.SetOffScreenRendering(1)
+        render_window.SetSize(*size)
+        render_window.AddRenderer(self.scene)
+        self.view_angle = self.scene.GetActiveCamera().GetViewAngle()
+        return render_window
+
+    def render_view(self, render_window, view):
+        """
+        Args:
+        render_window: vtkRenderWindow - Window from offscreen_window
+        view: string - Name of a CAM_SETTINGS view
+        Return: RGB image (height, width, 3) of the scene seen from the view
+        """
+        ## Start every view from the same zoom
+        self.scene.GetActiveCamera().SetViewAngle(self.view_angle)
+        self.scene.zoom(0.9)
+        self.set_fury_camera(self.scene, view)
+        self.display_view_slice(view)
+        return self.grab_image(render_window)
 
-    def Showmanger_init(self,di,rois,interactive,camera_view,output_path):
-        global selected_item
+    def grab_image(self, render_window):
+        """
+        Return: RGB image (height, width, 3) of the current render of the window
+        """
+        render_window.Render()
+        image = vtk.vtkWindowToImageFilter()
+        image.SetInput(render_window)
+        image.SetInputBufferTypeToRGB()
+        image.ReadFrontBufferOff()
+        image.Update()
+        width, height, _ = image.GetOutput().GetDimensions()
+        arr = numpy_support.vtk_to_numpy(image.GetOutput().GetPointData().GetScalars())
+        return np.flipud(arr.reshape(height, width, 3)).copy()
+
+    def saveresults_views(self, output_path, views, size=(2000, 2000)):
+        """
+        Args:
+        output_path: string - Prefix of the images, each view is saved to <output_path>_<view>.png
+        views: list - Names of CAM_SETTINGS views, or ['all'] for every view
+        size: (int, int) - Size of the images
+        Render several camera views of the already built scene in one offscreen window.
+        PNG encoding runs on a background thread while the next view renders.
+        """
+        if 'all' in views: views = list(self.CAM_SETTINGS.keys())
+        if output_path.endswith('.png'): output_path = output_path[:-len('.png')]
+        render_window = self.offscreen_window(size)
+        with ThreadPoolExecutor(max_workers=1) as encoder:
+            saving = []
+            for view in views:
+                if view not in self.CAM_SETTINGS:
+                    print(f"Invalid view: {view}. Choose from {list(self.CAM_SETTINGS.keys())}.")
+                    continue
+                fname = f"{output_path}_{view}.png"
+                saving.append((encoder.submit(save_image, self.render_view(render_window, view), fname), fname))
+            for future, fname in saving:
+                future.result()
+                print(f"Saved: {fname}")
+        render_window.RemoveRenderer(self.scene)
+        render_window.Finalize()
+
+    def save_frames(self, cameras, output_dir, size=(1920, 1080), video=None, fps=30, view='Coronal_A'):
+        """
+        Args:
+        cameras: list - (position, focal, view_up) of every frame
+        output_dir: string - Folder of the PNG sequence
+        size: (int, int) - Size of the frames
+        video: string - MP4 path written with imageio instead of the PNG sequence, if given
+        view: string - CAM_SETTINGS view used to cut the 2D brain slice
+        Render the frames of a camera path from the already built scene in one offscreen
+        window, encoding them in the background.
+        """
+        ## frames loads imageio, only needed when frames are recorded
+        from dive.frames import FrameEncoder
+        render_window = self.offscreen_window(size)
+        self.scene.zoom(0.9)
+        if view in self.CAM_SETTINGS: self.display_view_slice(view)
+        encoder = FrameEncoder(output_dir, video=video, fps=fps)
+        try:
+            for position, focal, view_up in cameras:
+                self.scene.set_camera(position=position, focal_point=focal, view_up=view_up)
+                encoder.submit(self.grab_image(render_window))
+        finally:
+            encoder.close()
+        print(f"Saved {encoder.count} frames: {video if encoder.writer is not None else output_dir}")
+        render_window.RemoveRenderer(self.scene)
+        render_window.Finalize()
+
+    def Showmanger_init(self,di,rois,interactive,camera_view,output_path,views=None,frames=None):
         self.size_screen = (1200,900)
         self.show_m = window.ShowManager(scene=self.scene,title='DiVE',size = self.size_screen)
-        if not interactive:
-            self.saveresults(output_path,view=camera_view)
+        if frames:
+            with profiler.stage('frames', frames=len(frames['cameras'])):
+                self.save_frames(view=camera_view, **frames)
+        elif not interactive and views:
+            with profiler.stage('first render', views=len(views)):
+                self.saveresults_views(output_path,views)
+        elif not interactive:
+            with profiler.stage('first render', view=camera_view):
+                self.saveresults(output_path,view=camera_view)
             
         else:
             self.slice_slider_label = self.build_label(text=str("Slice"))
@@ -1802,7 +2007,11 @@ class Show:
             self.combox_mesh = ComboBox2D(items=di['Mesh'],placeholder="Mesh: ",size=(290,150),others=[self.combox_brain,self.slice_slider,self.slice_slider_label])
             self.combox_track = ComboBox2D(items=di['Tract'],placeholder="Tract:  ",size=(290,150),others=[self.combox_brain,self.combox_mesh,self.slice_slider,self.slice_slider_label])
             self.combox_mask = ComboBox2D(items=di["Mask"],placeholder="Mask:  ",size=(290,150),others=[self.combox_brain,self.combox_track,self.combox_mesh])
+            for combo in (self.combox_brain,self.combox_mesh,self.combox_track,self.combox_mask):
+                combo.on_select = self.select_item
             self.rois = rois
+            self.output_path = output_path
+            if self.lifecycle is None: self.lifecycle = RoiLifecycle(rois)
             self.panel = Panel2D(size=(300, 400), color=(0.9, 0.9, 0.9), opacity=1, align='left')
             self.view = RadioButton(['Axial','Coronal','Sagittal'],checked_labels=['Sagittal'])
             self.flipper = Option('Flipped')
@@ -1811,17 +2020,32 @@ class Show:
             if self.slice_actor:
                 self.slice_actor.GetProperty().SetOpacity(0)
             self.interaction()
+            self.show_m.add_timer_callback(True, self.SLICE_UPDATE_MS, self.apply_slice)
+            self.perf_overlay()
+            ## Progress of the Add button, inside the panel next to the view buttons
+            self.loading_text = ui.TextBlock2D(font_size=12, color=(0, 0, 0))
+            self.panel.add_element(self.loading_text,(0.5,0.2))
+            self.show_m.add_timer_callback(True, 100, self.poll_loading)
+            if self.indexed:
+                self.show_m.add_timer_callback(True, 250, self.update_indexed)
+            if self.queryable:
+                self.show_m.iren.AddObserver('KeyPressEvent', self.roi_keys)
+                self.show_m.add_timer_callback(True, 100, self.apply_roi)
             self.show_m.scene.add(self.panel)
-            self.show_m.render()
+            if self.stats:
+                self.show_m.scene.add(self.stats_panel())
+            with profiler.stage('first render'):
+                self.show_m.render()
             self.show_m.start(multithreaded=True)
     
+    def select_item(self,combobox):
+        self.selected_item = combobox.selected_item
+
     def interact_selected_actor(self):
-        global selected_item
-        self.selected_actor = self.rois[selected_item]
+        self.selected_actor = self.rois[self.selected_item]
     
     def change_opacity(self,slider):
-        global selected_item
-        self.selected_actor = self.rois[selected_item]
+        self.selected_actor = self.rois[self.selected_item]
         if str(type(self.selected_actor))=="<class 'vtkmodules.vtkRenderingCore.vtkAssembly'>":
             slicer_opacity = slider.value
             for i in range(self.selected_actor.GetParts().GetNumberOfItems()):
@@ -1843,25 +2067,43 @@ class Show:
             command_csv_map_p_value = " ".join(command_csv_map_p_value) if command_csv_map_p_value!=None else "RdBu"
 
             if flag=="MASK":
+                from dive.csv_tocolors import Colors_csv
                 cc = Colors_csv(command_csv_path_mask)
                 color_map_mask = cc.assign_colors(map=command_csv_map_p_value,range_value = command_csv_range_p_value,log_p_value=command_csv_threshold_p_value,threshold=command_csv_threshold_mask)
                 return color_map_mask
 
 
-    def adding_elements(self,command):
+    def selected_paths(self,command):
+        """
+        Args:
+        command: string - Command line printed by the Viz_UI dialog
+        Return: lists of the mask, tract and mesh paths it selects
+        """
+        paths = []
+        for flag in ('mask','tract','mesh'):
+            matches = re.findall(rf'--{flag}\s(.*?)(?=\s--|$)', command)
+            paths.append(matches[0].split() if matches else [])
+        return paths
+
+    def adding_elements(self,command,restores):
+        """
+        Args:
+        command: string - Command line printed by the Viz_UI dialog
+        restores: dict - path -> (name, callable returning the actor) of the hidden ROIs the
+        command adds again, from RoiLifecycle.restore_job on the main thread
+        Return: list of dicts (kind, name, actor, source, builder, restored) to add to the scene
+        Loads and builds the selected files, runs on the loader thread: the lifecycle, rois and
+        combo boxes are only updated by poll_loading on the main thread
+        """
+        import pyvista as pv
+        from dive.loading import load
+        loaded = []
         matched_tract_index=0
         matched_mask_index=0
         width_tract_val=1
-        matches_mask = re.findall(r'--mask\s(.*?)(?=\s--|$)', command)
-        matches_mask = [match.split() for match in matches_mask]
-        matches_tract = re.findall(r'--tract\s(.*?)(?=\s--|$)', command)
-        matches_tract = [match.split() for match in matches_tract]
-        matches_mesh = re.findall(r'--mesh\s(.*?)(?=\s--|$)', command)
-        matches_mesh = [match.split() for match in matches_mesh]
+        matches_mask, matches_tract, matches_mesh = self.selected_paths(command)
         matches_csv = re.findall(r'--stats_csv\s(.*?)(?=\s--|$)', command)
         matches_csv = [match.split() for match in matches_csv]
-        matches_csv_tract = re.findall(r'--stats_csv_tract_value\s(.*?)(?=\s--|$)', command)
-        matches_csv_tract = [match.split() for match in matches_csv_tract]
         width_tract_val = re.findall(r'--width_tract\s(.*?)(?=\s--|$)', command)
         colors_tract = re.findall(r'--color_tract\s(.*?)(?=\s--|$)', command)
         colors_mask = re.findall(r'--color_mask\s(.*?)(?=\s--|$)', command)
@@ -1878,64 +2120,123 @@ class Show:
         if matches_csv:
             color_map_mask_val = self.handle_csv(command,flag="MASK")
         load_caller = load()
-        
-        if matches_mask:
-            for i in matches_mask[0]:
-                if colors_mask and len(colors_mask)>matched_mask_index:
-                    mask_value = load_caller.load_mask(mask_args = i,color=colors_mask[matched_mask_index])
-                
-                elif matches_csv and len(matches_csv)>matched_mask_index:
-                    mask_value = load_caller.load_mask(mask_args = i,color_map_mask=color_map_mask_val)
-
-                else:
-                    mask_value = load_caller.load_mask(mask_args = i)
-                self.combox_mask.append_item([os.path.basename(i)])
-                self.rois[os.path.basename(i)]=mask_value
-                self.show_m.scene.add(mask_value)
+
+        def restored(kind,path):
+            ## A removed ROI of the same file comes back from memory or the cache
+            name, restore_job = restores[path]
+            return {'kind': kind, 'name': name, 'actor': restore_job(), 'restored': True}
+
+        for i in matches_mask:
+            if i in restores:
+                loaded.append(restored('Mask',i))
                 matched_mask_index +=1
-        if matches_tract:
-            for i in matches_tract[0]:
-                if colors_tract and len(colors_tract)>matched_tract_index:
-                    tract_value = load_caller.load_tract(tract_args = i,tract_width=int(width_tract_val[0]),tract_color=colors_tract[matched_tract_index])
-                else:
-                    tract_value = load_caller.load_tract(tract_args = i,tract_width=int(width_tract_val[0]))
-                self.combox_track.append_item([os.path.basename(i)])
-                self.rois[os.path.basename(i)]=tract_value
-                self.show_m.scene.add(tract_value)
+                continue
+            if colors_mask and len(colors_mask)>matched_mask_index:
+                mask_value = load_caller.load_mask(mask_args = i,color=colors_mask[matched_mask_index])
+            
+            elif matches_csv and len(matches_csv)>matched_mask_index:
+                mask_value = load_caller.load_mask(mask_args = i,color_map_mask=color_map_mask_val)
+
+            else:
+                mask_value = load_caller.load_mask(mask_args = i)
+            loaded.append({'kind': 'Mask', 'name': os.path.basename(i), 'actor': mask_value, 'source': i, 'builder': None, 'restored': False})
+            matched_mask_index +=1
+        for i in matches_tract:
+            if i in restores:
+                loaded.append(restored('Tract',i))
                 matched_tract_index= matched_tract_index+1
-        if matches_mesh:
-            index_mesh = 0
-            for i in matches_mesh[0]:
-                if colors_mesh and len(colors_mesh)>index_mesh:
-                    mesh_caller = Mesh(pv.PolyData(i),colors_mesh[index_mesh])
-                else:
-                    mesh_caller = Mesh(pv.PolyData(i),color_list=Colors.get_tab20_color(index = index_mesh, type_='vtk'))
-                index_mesh += 1
-                actor_vtk = mesh_caller.load_mesh()
-                self.combox_mesh.append_item([os.path.basename(i)])
-                self.rois[os.path.basename(i)]= actor_vtk
-
-                self.show_m.scene.add(actor_vtk)
-        self.indexxx+=1
+                continue
+            if colors_tract and len(colors_tract)>matched_tract_index:
+                tract_value = load_caller.load_tract(tract_args = i,tract_width=int(width_tract_val[0]),tract_color=colors_tract[matched_tract_index])
+                builder = partial(load().load_tract,tract_args = i,tract_width=int(width_tract_val[0]),tract_color=colors_tract[matched_tract_index])
+            else:
+                tract_value = load_caller.load_tract(tract_args = i,tract_width=int(width_tract_val[0]))
+                builder = partial(load().load_tract,tract_args = i,tract_width=int(width_tract_val[0]))
+            ## Tracts colored from a multi-label mask depend on that mask and are kept in memory
+            loaded.append({'kind': 'Tract', 'name': os.path.basename(i), 'actor': tract_value, 'source': i,
+                           'builder': None if load_caller.flag_multple else builder, 'restored': False})
+            matched_tract_index= matched_tract_index+1
+        for index_mesh, i in enumerate(matches_mesh):
+            if i in restores:
+                loaded.append(restored('Mesh',i))
+                continue
+            if colors_mesh and len(colors_mesh)>index_mesh:
+                mesh_caller = Mesh(pv.PolyData(i),colors_mesh[index_mesh])
+            else:
+                mesh_caller = Mesh(pv.PolyData(i),color_list=Colors.get_tab20_color(index = index_mesh, type_='vtk'))
+            loaded.append({'kind': 'Mesh', 'name': os.path.basename(i), 'actor': mesh_caller.load_mesh(), 'source': i, 'builder': None, 'restored': False})
+        return loaded
         
     def add_element(self,option):
-        # Create an NSOpenPanel to display the file dialog
-            completed_process = subprocess.run(['python', os.path.dirname(__file__)+'/Viz_UI.py'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-            selected_file_path = completed_process.stdout
-            self.adding_elements(selected_file_path)
+        ## The file dialog runs in its own process so Tk does not compete with the VTK event loop,
+        ## poll_loading picks up its output without blocking the viewer
+        if self.dialog is not None: return
+        self.dialog = subprocess.Popen([sys.executable, os.path.dirname(__file__)+'/Viz_UI.py'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        self.update_loading_text()
+
+    def update_loading_text(self):
+        if self.dialog is not None:
+            self.loading_text.message = "Choosing files..."
+        elif self.loading:
+            self.loading_text.message = f"Loading ({len(self.loading)})..."
+        else:
+            self.loading_text.message = ""
+
+    def poll_loading(self,_obj=None,_event=None):
+        """
+        Timer callback starting the background load once the dialog is closed and
+        adding the actors of finished loads to the scene
+        """
+        changed = False
+        if self.dialog is not None and self.dialog.poll() is not None:
+            command = self.dialog.communicate()[0]
+            self.dialog = None
+            if command.strip():
+                ## Hidden ROIs of the chosen files are looked up here, the loader thread only rebuilds them
+                restores = {}
+                for path in sum(self.selected_paths(command), []):
+                    name = self.lifecycle.hidden_source(path)
+                    if name is not None: restores[path] = (name, self.lifecycle.restore_job(name))
+                if self.loader is None: self.loader = ThreadPoolExecutor(max_workers=1)
+                self.loading.append(self.loader.submit(self.adding_elements, command, restores))
+            changed = True
+        for future in [f for f in self.loading if f.done()]:
+            self.loading.remove(future)
+            try:
+                combo_boxes = {'Mask': self.combox_mask, 'Tract': self.combox_track, 'Mesh': self.combox_mesh}
+                for item in future.result():
+                    if item['actor'] is None: continue
+                    if not item['restored']:
+                        self.lifecycle.register(item['name'],item['kind'],source=item['source'],builder=item['builder'])
+                    combo_boxes[item['kind']].append_item([item['name']])
+                    self.lifecycle.shown(item['name'], item['actor'])
+                    self.show_m.scene.add(item['actor'])
+            except Exception as error:
+                print(f"Could not load the added files: {error}")
+            changed = True
+        if changed:
+            self.update_loading_text()
+            self.show_m.render()
 
     def remove_element(self,option):
-        global selected_item
         remove_combo_box = None
-        if selected_item in self.combox_mesh.items:
+        if self.selected_item in self.combox_mesh.items:
             remove_combo_box = self.combox_mesh
-        elif selected_item in self.combox_mask.items:
+        elif self.selected_item in self.combox_mask.items:
             remove_combo_box = self.combox_mask
-        elif selected_item in self.combox_track.items:
+        elif self.selected_item in self.combox_track.items:
              remove_combo_box = self.combox_track
-        self.selected_actor = self.rois[selected_item]
-        remove_combo_box.remove_item(selected_item)
-        self.show_m.scene.rm(self.selected_actor)
+        roi = self.rois[self.selected_item]
+        remove_combo_box.remove_item(self.selected_item)
+        ## Drop the viewer's own reference so a released ROI is freed
+        self.selected_actor = None
+        if isinstance(roi, BundleView):
+            ## Batched bundles share one actor, hiding the bundle's lookup table entry removes it
+            roi.VisibilityOff()
+        else:
+            ## The lifecycle manager may release the removed ROI, adding its file again rebuilds it
+            self.lifecycle.hide(self.selected_item, self.show_m.scene)
+        self.show_m.render()
 
     def flip_view(self,option):
         if self.flipper.checked:
@@ -1953,17 +2254,182 @@ class Show:
             if self.ori==3:
                 self.scene.set_camera(position=(0, 400, 0), focal_point=(0, 0, 0), view_up=(0, 0, 1))
 
+    def perf_overlay(self):
+        """
+        Builds the hidden frame-time and scene-cost overlay, toggled with the 'p' key
+        """
+        color = (0, 0, 0) if self.background == 1 else (1, 1, 1)
+        self.perf_text = ui.TextBlock2D(position=(self.size_screen[0] - 10, self.size_screen[1] - 10), font_size=14, color=color, justification='right', vertical_justification='top')
+        self.perf_text.set_visibility(False)
+        self.show_m.scene.add(self.perf_text)
+        self.show_m.window.AddObserver('EndEvent', self.count_frame)
+        self.show_m.iren.AddObserver('KeyPressEvent', self.toggle_perf)
+        self.show_m.add_timer_callback(True, 1000, self.update_perf)
+
+    def count_frame(self,_obj=None,_event=None):
+        ## The render refreshing the overlay text is not a frame of the scene
+        if not self.perf_rendering: self.frames += 1
+
+    def scene_costs(self):
+        """
+        Return: dict of the rendering cost (actor_cost) of every ROI in the scene, the bundles
+        drawn by one TractBatch are listed once as that batched actor
+        """
+        costs, batches = {}, []
+        for name, roi in self.rois.items():
+            if roi is None: continue
+            if isinstance(roi, BundleView):
+                if any(roi.batch is batch for batch in batches): continue
+                batches.append(roi.batch)
+                costs[f"batch of {len(roi.batch.names)} bundles"] = actor_cost(roi.batch.actor)
+            else:
+                costs[name] = actor_cost(roi)
+        return costs
+
+    def toggle_perf(self,obj,_event):
+        if obj.GetKeySym() not in ('p', 'P'): return
+        self.perf_visible = not self.perf_visible
+        self.perf_text.set_visibility(self.perf_visible)
+        if self.perf_visible:
+            ## Log the full table, the overlay only keeps the most expensive ROIs
+            for name, cost in self.scene_costs().items():
+                print(f"{name}: {cost['points']} points, {cost['cells']} cells, {cost['triangles']} triangles, CPU {cost['cpu_mb']:.1f} MB, GPU ~{cost['gpu_mb']:.1f} MB")
+            self.frames, self.frame_clock = 0, time.perf_counter()
+            self.update_perf()
+        self.show_m.render()
+
+    def update_perf(self,_obj=None,_event=None):
+        """
+        Timer callback refreshing the overlay with the FPS, the last frame time and the ROI costs
+        """
+        if not self.perf_visible: return
+        now = time.perf_counter()
+        fps = self.frames / (now - self.frame_clock) if now > self.frame_clock else 0
+        self.frames, self.frame_clock = 0, now
+        frame_ms = 1000 * self.scene.GetLastRenderTimeInSeconds()
+        lines = [f"FPS {fps:.1f}   last frame {frame_ms:.1f} ms"]
+        costs = sorted(self.scene_costs().items(), key=lambda item: -item[1]['gpu_mb'])
+        for name, cost in costs[:8]:
+            lines.append(f"{name}: {cost['points']:,} pts  {cost['cells']:,} cells  {cost['triangles']:,} tris  {cost['cpu_mb']:.1f}/{cost['gpu_mb']:.1f} MB")
+        self.perf_text.message = "\n".join(lines)
+        print(lines[0])
+        self.perf_rendering = True
+        try:
+            self.show_m.render()
+        finally:
+            self.perf_rendering = False
+
+    def update_indexed(self,_obj=None,_event=None):
+        """
+        Timer callback reloading the indexed tracts with the streamlines inside the view
+        frustum, once the camera has not moved for one tick
+        """
+        camera = self.scene.GetActiveCamera()
+        state = camera.GetPosition() + camera.GetFocalPoint() + camera.GetViewUp() + (camera.GetViewAngle(), camera.GetParallelScale())
+        if state != self.camera_state:
+            self.camera_state, self.camera_moved = state, True
+            return
+        if not self.camera_moved: return
+        self.camera_moved = False
+        changed = False
+        for name, indexed in self.indexed.items():
+            if name not in self.rois or name in self.lifecycle.hidden: continue
+            ids = indexed.frustum_ids(camera, self.scene.GetTiledAspectRatio())
+            if indexed.current is not None and np.array_equal(ids, indexed.current): continue
+            old_actor = self.rois[name]
+            new_actor = indexed.build_actor(ids)
+            new_actor.GetProperty().SetOpacity(old_actor.GetProperty().GetOpacity())
+            self.show_m.scene.rm(old_actor)
+            self.show_m.scene.add(new_actor)
+            self.rois[name] = new_actor
+            changed = True
+        if changed: self.show_m.render()
+
+    def roi_keys(self,obj,_event):
+        """
+        'o' places a sphere ROI, 'b' a box ROI (the same key removes it), 'x' exports the
+        streamlines inside the ROI to TRX
+        """
+        key = obj.GetKeySym()
+        if key in ('o', 'b'):
+            shape = 'sphere' if key == 'o' else 'box'
+            current = self.roi_widget
+            self.clear_roi()
+            if current is None or current[0] != shape:
+                self.place_roi(shape)
+            self.show_m.render()
+        elif key == 'x' and self.roi_ids:
+            folder = os.path.dirname(self.output_path) if self.output_path else os.getcwd()
+            for name, ids in self.roi_ids.items():
+                if len(ids): self.queryable[name].export(ids, os.path.join(folder, f"{name}_roi.trx"))
+
+    def place_roi(self,shape):
+        bounds = [0.0] * 6
+        self.scene.ComputeVisiblePropBounds(bounds)
+        if shape == 'sphere':
+            widget = vtk.vtkSphereWidget()
+            widget.SetRepresentationToWireframe()
+        else:
+            widget = vtk.vtkBoxWidget()
+            widget.RotationEnabledOff()
+        widget.SetInteractor(self.show_m.iren)
+        widget.SetPlaceFactor(0.25)
+        widget.PlaceWidget(bounds)
+        widget.AddObserver('InteractionEvent', self.roi_moved)
+        widget.On()
+        self.roi_widget = (shape, widget)
+        self.roi_moved(widget)
+
+    def roi_moved(self,widget,_event=None):
+        ## Only keep the latest ROI, apply_roi queries at most once per tick
+        if self.roi_widget[0] == 'sphere':
+            self.pending_roi = ('sphere', widget.GetCenter(), widget.GetRadius())
+        else:
+            polydata = vtk.vtkPolyData()
+            widget.GetPolyData(polydata)
+            bounds = polydata.GetBounds()
+            self.pending_roi = ('box', bounds[0::2], bounds[1::2])
+
+    def apply_roi(self,_obj=None,_event=None):
+        """
+        Timer callback showing only the streamlines of the queryable tracts inside the ROI
+        """
+        if self.pending_roi is None: return
+        roi, self.pending_roi = self.pending_roi, None
+        for name, query in self.queryable.items():
+            if name not in self.rois or name in self.lifecycle.hidden: continue
+            ids = query.select(*roi)
+            if name in self.roi_actors:
+                self.show_m.scene.rm(self.roi_actors.pop(name))
+            self.roi_ids[name] = ids
+            self.rois[name].SetVisibility(False)
+            if len(ids):
+                self.roi_actors[name] = query.build_actor(ids)
+                self.show_m.scene.add(self.roi_actors[name])
+        self.show_m.render()
+
+    def clear_roi(self):
+        if self.roi_widget is None: return
+        self.roi_widget[1].Off()
+        self.roi_widget, self.pending_roi = None, None
+        for name, roi_actor in self.roi_actors.items():
+            self.show_m.scene.rm(roi_actor)
+        for name in self.roi_ids:
+            if name in self.rois: self.rois[name].SetVisibility(True)
+        self.roi_ids, self.roi_actors = {}, {}
+
     def change_slice_handler(self,slider):
-        self.slider_cut = int(slider.value)
-        self.scene.rm(self.slice_actor)
-        if self.ori==1:
-            self.slice_actor.display(x=self.slider_cut,y=None,z=None)
-        elif self.ori==2:
-            self.slice_actor.display(x=None,y=None,z=self.slider_cut)
-        elif self.ori==3:
-            self.slice_actor.display(x=None,y=self.slider_cut,z=None)
-        self.scene.add(self.slice_actor)
+        ## Only keep the latest value, apply_slice updates the slice at most once per frame
+        self.pending_cut = int(slider.value)
 
+    def apply_slice(self,_obj=None,_event=None):
+        """
+        Timer callback applying the latest slider value to the slice actor and rendering once
+        """
+        if self.pending_cut is None or self.slice_actor is None: return
+        self.slider_cut, self.pending_cut = self.pending_cut, None
+        self.display_cut(self.slider_cut)
+        self.show_m.render()
 
     def interaction(self):
         self.opacity_slider.on_change = self.change_opacity
@@ -0,0 +1,379 @@
+import os
+import numpy as np
+import nibabel as nib
+from dive.tract import Tract
+
+## Points read from the memmap at a time while building the index
+CHUNK_POINTS = 4000000
+
+
+def morton_encode(ijk, depth):
+    """
+    Interleaves the bits of integer cell coordinates so that sorting the codes visits the
+    cells in octree order.
+    Args:
+        ijk: array (n, 3) of cell coordinates below 2**depth
+        depth: number of octree levels
+    Returns:
+        code: int64 array of n Morton codes
+    """
+    ijk = np.asarray(ijk, dtype=np.int64)
+    code = np.zeros(len(ijk), dtype=np.int64)
+    for bit in range(depth):
+        for axis in range(3):
+            code |= ((ijk[:, axis] >> bit) & 1) << (3 * bit + axis)
+    return code
+
+
+def chunk_ranges(lengths, chunk_points=CHUNK_POINTS):
+    """
+    Returns: list of (first, last+1) streamline ranges with about chunk_points points each
+    """
+    ends = np.cumsum(lengths)
+    ranges, first = [], 0
+    while first < len(lengths):
+        last = int(np.searchsorted(ends, ends[first] - lengths[first] + chunk_points, side='right'))
+        last = max(last, first + 1)
+        ranges.append((first, last))
+        first = last
+    return ranges
+
+
+def bounding_box(streamlines):
+    """
+    Returns: (lo, hi) corners of the points of packed streamlines, read chunk by chunk
+    """
+    data, offsets, lengths = streamlines._data, np.asarray(streamlines._offsets), np.asarray(streamlines._lengths)
+    lo, hi = np.full(3, np.inf), np.full(3, -np.inf)
+    for first, last in chunk_ranges(lengths):
+        pts = data[offsets[first]:offsets[last - 1] + lengths[last - 1]]
+        lo, hi = np.minimum(lo, pts.min(axis=0)), np.maximum(hi, pts.max(axis=0))
+    return lo, hi
+
+
+def cell_streamline_csr(streamlines, cell_key):
+    """
+    Lists the streamlines passing through every occupied cell, from the flat point buffer.
+    Args:
+        streamlines: ArraySequence with packed points (TRX memmap or in memory)
+        cell_key: function mapping an array (n, 3) of points to n int64 cell keys below 2**31
+    Returns:
+        keys: sorted keys of the occupied cells
+        offsets: CSR offsets, the streamlines of keys[r] are ids[offsets[r]:offsets[r+1]]
+        ids: uint32 streamline indices
+    """
+    data, offsets, lengths = streamlines._data, np.asarray(streamlines._offsets), np.asarray(streamlines._lengths)
+    pairs = []
+    for first, last in chunk_ranges(lengths):
+        pts = np.asarray(data[offsets[first]:offsets[last - 1] + lengths[last - 1]], dtype=np.float64)
+        sid = np.repeat(np.arange(first, last, dtype=np.int64), lengths[first:last])
+        pairs.append(np.unique((cell_key(pts) << 32) | sid))
+    pairs = np.unique(np.concatenate(pairs)) if pairs else np.zeros(0, dtype=np.int64)
+    keys, starts = np.unique(pairs >> 32, return_index=True)
+    return keys, np.append(starts, len(pairs)).astype(np.int64), (pairs & 0xFFFFFFFF).astype(np.uint32)
+
+
+def csr_gather(offsets, ids, rows):
+    """
+    Returns: sorted unique ids listed by the given CSR rows
+    """
+    starts, counts = offsets[rows], offsets[rows + 1] - offsets[rows]
+    if counts.sum() == 0: return np.zeros(0, dtype=np.int64)
+    positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return np.unique(ids[positions]).astype(np.int64)
+
+
+def filter_inside(streamlines, ids, inside):
+    """
+    Exact test of the candidates proposed by an index.
+    Args:
+        streamlines: ArraySequence
+        ids: candidate streamline ids
+        inside: function of (points, 3) float64 points returning a boolean per point
+    Returns:
+        ids: the candidates with at least one point inside
+    """
+    if len(ids) == 0: return ids
+    candidates = streamlines[ids]
+    lengths = np.asarray(candidates._lengths)
+    hits = inside(np.asarray(candidates.get_data(), dtype=np.float64))
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return ids[np.add.reduceat(hits, starts) > 0]
+
+
+def inside_box(box_min, box_max):
+    return lambda pts: np.all((pts >= np.asarray(box_min)) & (pts <= np.asarray(box_max)), axis=1)
+
+
+class StreamlineOctree:
+    """
+    Linear octree over the points of a tractogram: the occupied leaf cells, sorted by Morton
+    code, each list the streamlines passing through them (CSR arrays). Built in chunks from
+    the flat point buffer, so a memory mapped TRX file is never loaded whole, and saved next
+    to the file to be reused.
+    """
+
+    def __init__(self, origin, cell_size, depth, cells, offsets, ids):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.cell_size = float(cell_size)
+        self.depth = int(depth)
+        self.cells = cells
+        self.offsets = offsets
+        self.ids = ids
+
+    @classmethod
+    def build(cls, streamlines, depth=7):
+        """
+        Args:
+            streamlines: ArraySequence (TRX memmap or in memory) with packed points
+            depth: octree levels, the leaves are cubes of (bounding box size) / 2**depth
+        Returns:
+            octree: StreamlineOctree
+        """
+        lo, hi = bounding_box(streamlines)
+        n = 2 ** depth
+        cell_size = max(float(np.max(hi - lo)) / n, 1e-6) * (1 + 1e-6)
+        cell_codes, offsets, ids = cell_streamline_csr(streamlines, lambda pts: morton_encode(np.clip(((pts - lo) / cell_size).astype(np.int64), 0, n - 1), depth))
+        ## Decode the leaf coordinates once, queries test them vectorized
+        cells = np.zeros((len(cell_codes), 3), dtype=np.int64)
+        for bit in range(depth):
+            for axis in range(3):
+                cells[:, axis] |= ((cell_codes >> (3 * bit + axis)) & 1) << bit
+        return cls(lo, cell_size, depth, cells.astype(np.uint16), offsets, ids)
+
+    @staticmethod
+    def index_path(trx_path):
+        return trx_path + '.octree.npz'
+
+    def save(self, path, stamp):
+        np.savez(path, origin=self.origin, cell_size=self.cell_size, depth=self.depth, cells=self.cells,
+                 offsets=self.offsets, ids=self.ids, stamp=np.asarray(stamp, dtype=np.int64))
+
+    @classmethod
+    def load_or_build(cls, trx_path, streamlines, depth=7):
+        """
+        Loads the index saved next to trx_path, or builds and saves it when it is missing or
+        older than the file.
+        Returns:
+            octree: StreamlineOctree
+        """
+        stat = os.stat(trx_path)
+        stamp = [stat.st_size, stat.st_mtime_ns, depth]
+        path = cls.index_path(trx_path)
+        if os.path.exists(path):
+            saved = np.load(path)
+            if list(saved['stamp']) == stamp:
+                return cls(saved['origin'], saved['cell_size'], saved['depth'], saved['cells'], saved['offsets'], saved['ids'])
+        octree = cls.build(streamlines, depth=depth)
+        try:
+            octree.save(path, stamp)
+        except OSError as error:
+            print(f"Could not save the octree index {path}: {error}")
+        return octree
+
+    def gather(self, leaves):
+        """
+        Returns: sorted unique ids of the streamlines listed by the given leaves
+        """
+        return csr_gather(self.offsets, self.ids, leaves)
+
+    def query_box(self, box_min, box_max):
+        """
+        Args:
+            box_min, box_max: corners of the box in the streamline space (mm)
+        Returns:
+            ids: streamlines with a point in a leaf touching the box
+        """
+        lo = np.floor((np.asarray(box_min) - self.origin) / self.cell_size) - 1
+        hi = np.floor((np.asarray(box_max) - self.origin) / self.cell_size) + 1
+        leaves = np.flatnonzero(np.all((self.cells >= lo) & (self.cells <= hi), axis=1))
+        return self.gather(leaves)
+
+    def query_frustum(self, planes):
+        """
+        Args:
+            planes: 24 values, the (a, b, c, d) of the 6 inward frustum planes (vtkCamera.GetFrustumPlanes)
+        Returns:
+            ids: streamlines with a point in a leaf that is at least partly inside the frustum
+        """
+        planes = np.asarray(planes, dtype=np.float64).reshape(6, 4)
+        half = self.cell_size / 2
+        centers = self.origin + (self.cells + 0.5) * self.cell_size
+        ## A leaf is outside when its nearest corner is behind one of the planes
+        reach = half * np.abs(planes[:, :3]).sum(axis=1)
+        distance = centers @ planes[:, :3].T + planes[:, 3]
+        leaves = np.flatnonzero(np.all(distance + reach >= 0, axis=1))
+        return self.gather(leaves)
+
+
+class IndexedTract:
+    """
+    Tract drawn from a memory mapped TRX file through its octree: only the streamlines of the
+    queried region are read from disk and uploaded, at most max_streamlines of them.
+    """
+
+    def __init__(self, trx_path, tract_image, tw=1, color=None, max_streamlines=200000, depth=7):
+        self.streamlines = tract_image.streamlines
+        self.octree = StreamlineOctree.load_or_build(trx_path, self.streamlines, depth=depth)
+        self.tract_width = tw
+        self.color = color
+        self.max_streamlines = max_streamlines
+        self.current = None
+
+    def subset(self, ids):
+        """
+        Returns: in-memory float32 ArraySequence of the streamlines ids, evenly thinned to max_streamlines
+        """
+        if len(ids) > self.max_streamlines:
+            ids = ids[np.linspace(0, len(ids) - 1, self.max_streamlines).astype(np.int64)]
+        bundle = self.streamlines[ids].copy()
+        bundle._data = bundle._data.astype(np.float32)
+        return bundle
+
+    def build_actor(self, ids):
+        self.current = ids
+        if self.color is not None:
+            return Tract(bundle=self.subset(ids), tw=self.tract_width, color_list=self.color).single_color()
+        return Tract(bundle=self.subset(ids), tw=self.tract_width).dirrection_color()
+
+    def all_ids(self):
+        return np.arange(len(self.streamlines))
+
+    def box_actor(self, box_min, box_max):
+        ## The octree leaves are padded around the box, keep the streamlines really inside
+        ids = filter_inside(self.streamlines, self.octree.query_box(box_min, box_max), inside_box(box_min, box_max))
+        return self.build_actor(ids)
+
+    def frustum_ids(self, camera, aspect):
+        planes = [0.0] * 24
+        camera.GetFrustumPlanes(aspect, planes)
+        return self.octree.query_frustum(planes)
+
+
+class VoxelStreamlineIndex:
+    """
+    Inverted index from voxels to the streamlines passing through them, as CSR arrays over the
+    occupied voxels sorted by key. A ROI query is a union over the few voxels it covers
+    instead of a scan over every point.
+    """
+
+    def __init__(self, streamlines, voxel_size=1.0):
+        """
+        Args:
+            streamlines: ArraySequence with packed points
+            voxel_size: edge of the index voxels (mm)
+        """
+        self.voxel_size = float(voxel_size)
+        lo, hi = bounding_box(streamlines)
+        self.origin = lo
+        self.shape = np.floor((hi - lo) / self.voxel_size).astype(np.int64) + 1
+        self.keys, self.offsets, self.ids = cell_streamline_csr(streamlines, lambda pts: self.voxel_keys(self.voxel_of(pts)))
+
+    def voxel_of(self, pts):
+        return np.floor((np.asarray(pts, dtype=np.float64) - self.origin) / self.voxel_size).astype(np.int64)
+
+    def voxel_keys(self, ijk):
+        return (ijk[:, 0] * self.shape[1] + ijk[:, 1]) * self.shape[2] + ijk[:, 2]
+
+    def query_voxels(self, ijk):
+        """
+        Returns: ids of the streamlines passing through any of the voxels ijk (n, 3)
+        """
+        ijk = ijk[np.all((ijk >= 0) & (ijk < self.shape), axis=1)]
+        keys = self.voxel_keys(ijk)
+        rows = np.searchsorted(self.keys, keys)
+        valid = rows < len(self.keys)
+        rows, keys = rows[valid], keys[valid]
+        rows = rows[self.keys[rows] == keys]
+        return csr_gather(self.offsets, self.ids, rows)
+
+    def voxel_grid(self, box_min, box_max):
+        lo = np.maximum(self.voxel_of([box_min])[0], 0)
+        hi = np.minimum(self.voxel_of([box_max])[0], self.shape - 1)
+        if np.any(hi < lo): return np.zeros((0, 3), dtype=np.int64)
+        return np.stack(np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(lo, hi)], indexing='ij'), axis=-1).reshape(-1, 3)
+
+    def query_box(self, box_min, box_max):
+        """
+        Returns: ids of the streamlines with a point in a voxel touching the box
+        """
+        return self.query_voxels(self.voxel_grid(box_min, box_max))
+
+    def query_sphere(self, center, radius):
+        """
+        Returns: ids of the streamlines with a point in a voxel touching the sphere
+        """
+        center = np.asarray(center, dtype=np.float64)
+        ijk = self.voxel_grid(center - radius, center + radius)
+        centers = self.origin + (ijk + 0.5) * self.voxel_size
+        reach = radius + self.voxel_size * np.sqrt(3) / 2
+        return self.query_voxels(ijk[np.linalg.norm(centers - center, axis=1) <= reach])
+
+
+class StreamlineQuery:
+    """
+    ROI queries on one tract of the viewer: the voxel index proposes candidate streamlines and
+    their points are tested exactly against the sphere or box.
+    """
+
+    def __init__(self, tract_image, tw=1, color=None, voxel_size=1.0, reference=None):
+        """
+        Args:
+            tract_image: loaded tractogram (nibabel or TRX) the streamlines come from
+            reference: NIfTI file used when exporting tracts without a voxel grid in their header (TCK)
+        """
+        self.tract_image = tract_image
+        ## Spatial reference of the exported TRX: TRX files carry their own, TRK files their
+        ## header, TCK files have none and need the NIfTI reference
+        if reference is None and isinstance(tract_image, nib.streamlines.TrkFile):
+            reference = tract_image.header
+        self.reference = reference
+        self.exportable = reference is not None or not isinstance(tract_image, nib.streamlines.TckFile)
+        if not self.exportable:
+            print("The ROI streamlines of this tract cannot be exported without a reference image, give one with --brain_2d")
+        self.streamlines = tract_image.streamlines
+        self.index = VoxelStreamlineIndex(self.streamlines, voxel_size=voxel_size)
+        self.tract_width = tw
+        self.color = color
+
+    def select(self, shape, *params):
+        """
+        Args:
+            shape: 'sphere' with params (center, radius) or 'box' with params (box_min, box_max)
+        Returns:
+            ids: indices of the streamlines with a point inside the ROI
+        """
+        if shape == 'sphere':
+            ids = self.index.query_sphere(*params)
+            inside = lambda pts: np.linalg.norm(pts - np.asarray(params[0]), axis=1) <= params[1]
+        else:
+            ids = self.index.query_box(*params)
+            inside = inside_box(*params)
+        return filter_inside(self.streamlines, ids, inside)
+
+    def build_actor(self, ids):
+        bundle = self.streamlines[ids].copy()
+        bundle._data = bundle._data.astype(np.float32)
+        if self.color is not None:
+            return Tract(bundle=bundle, tw=self.tract_width, color_list=self.color).single_color()
+        return Tract(bundle=bundle, tw=self.tract_width).dirrection_color()
+
+    def export(self, ids, path):
+        """
+        Saves the streamlines ids to a TRX file.
+        Args:
+            ids: indices of the streamlines to keep
+            path: output .trx path
+        """
+        if not self.exportable:
+            print(f"Cannot export {path}: the tract has no spatial reference, give one with --brain_2d")
+            return
+        import trx.trx_file_memmap as tmm
+        from dipy.io.stateful_tractogram import StatefulTractogram, Space
+        if isinstance(self.tract_image, tmm.TrxFile):
+            subset = self.tract_image.select(ids)
+        else:
+            sft = StatefulTractogram(self.streamlines[ids], self.reference, Space.RASMM)
+            subset = tmm.TrxFile.from_sft(sft)
+        tmm.save(subset, path)
+        print(f"Saved {len(ids)} streamlines: {path}")
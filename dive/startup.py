@@ -0,0 +1,79 @@
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+## Modules that must not be loaded by `import dive.main` (they are imported once the
+## arguments are parsed, or only by the features using them)
+HEAVY_MODULES = ['vtk', 'vtkmodules', 'fury', 'pyvista', 'pandas', 'matplotlib', 'scipy', 'dipy',
+                 'tslearn', 'trx', 'distinctipy', 'tkinter', 'nibabel']
+
+## Printed by the child process: the heavy modules it ended up loading
+CHECK_IMPORTS = ("import sys, json, dive.main; "
+                 "print(json.dumps(sorted({m.split('.')[0] for m in sys.modules} & set(sys.argv[1:]))))")
+
+## Viewer modules, and the optional modules they must only load in the features using them
+## (dipy for segmentation, trx for TRX files, pyarrow for Feather/Parquet, imageio for videos)
+VIEWER_MODULES = ['dive.helper', 'dive.tract', 'dive.loading', 'dive.showman']
+FEATURE_MODULES = ['dipy', 'trx', 'pyarrow', 'imageio']
+CHECK_VIEWER_IMPORTS = ("import sys, json, importlib; n = int(sys.argv[1]); "
+                        "[importlib.import_module(m) for m in sys.argv[2:2 + n]]; "
+                        "print(json.dumps(sorted({m.split('.')[0] for m in sys.modules} & set(sys.argv[2 + n:]))))")
+
+
+def time_command(command, repeat=5):
+    """
+    Args:
+        command: argument list of the process to time
+        repeat: number of runs, the fastest one is kept
+    Returns:
+        seconds: best wall time of the command
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_startup_check(argv=None):
+    """
+    Startup guard of the CLI: checks that importing dive.main loads none of HEAVY_MODULES, that
+    importing the viewer modules loads none of FEATURE_MODULES and that `dive --help` stays
+    under a time budget. Exits with 1 when any check fails.
+    Usage: python -m dive.startup [--budget 0.5] [--repeat 5]
+    """
+    parser = argparse.ArgumentParser(description='Check the import time of the dive CLI')
+    parser.add_argument('--budget', type=float, default=0.5, help='Maximum time (seconds) of dive --help')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs, the fastest one is kept')
+    args = parser.parse_args(argv)
+
+    loaded = json.loads(subprocess.run([sys.executable, '-c', CHECK_IMPORTS] + HEAVY_MODULES,
+                                       capture_output=True, text=True, check=True).stdout)
+    viewer = subprocess.run([sys.executable, '-c', CHECK_VIEWER_IMPORTS, str(len(VIEWER_MODULES))] + VIEWER_MODULES + FEATURE_MODULES,
+                            capture_output=True, text=True)
+    baseline = time_command([sys.executable, '-c', 'pass'], args.repeat)
+    help_time = time_command([sys.executable, '-c', 'import sys; sys.argv = ["dive", "--help"]; from dive.main import run_main; run_main()'], args.repeat)
+
+    print(f"Interpreter startup: {1000 * baseline:.0f} ms")
+    print(f"dive --help: {1000 * help_time:.0f} ms (budget {1000 * args.budget:.0f} ms)")
+    failed = False
+    if loaded:
+        print(f"import dive.main loads: {', '.join(loaded)}")
+        failed = True
+    if viewer.returncode != 0:
+        print(f"Importing {', '.join(VIEWER_MODULES)} failed:\n{viewer.stderr.strip().splitlines()[-1]}")
+        failed = True
+    elif json.loads(viewer.stdout):
+        print(f"The viewer modules load: {', '.join(json.loads(viewer.stdout))}")
+        failed = True
+    if help_time > args.budget:
+        print("dive --help is over the budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    run_startup_check()
@@ -1,13 +1,46 @@
-import distinctipy
 import numpy as np
 import nibabel as nib
 from fury import actor, colormap
-from scipy.spatial import cKDTree
 from dive.csv_tocolors import Colors_csv
-from dipy.segment.clustering import QuickBundles
-from dive.helper import perform_dtw,segment_bundle,bundle_density,create_mask_from_trk
-from dipy.segment.metric import AveragePointwiseEuclideanMetric
-from dipy.tracking.streamline import (Streamlines,set_number_of_points)
+from nibabel.streamlines import ArraySequence
+from dive.helper import perform_dtw,segment_bundle,bundle_density,create_mask_from_trk,map_actor_through_lut,colors_to_lut
+
+def arc_length_segments(streamlines, num_segments):
+    """
+    Assigns every point to one of num_segments segments from its normalized
+    cumulative arc length along its own streamline. Streamlines are first oriented
+    like the longest one, so segment 0 is always at the same end of the bundle.
+    Computed in one pass over the flat point buffer.
+    Args:
+        streamlines: ArraySequence of the bundle
+        num_segments: number of segments along the length
+    Returns:
+        indx: array with the segment (0 to num_segments-1) of every point
+    """
+    pts = np.asarray(streamlines.get_data(), dtype=np.float64)
+    lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+    lengths = lengths[lengths > 0]
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    ends = starts + lengths - 1
+
+    ## Cumulative arc length, restarted at the first point of every streamline
+    step = np.zeros(len(pts))
+    step[1:] = np.linalg.norm(np.diff(pts, axis=0), axis=1)
+    step[starts] = 0
+    cum = np.cumsum(step)
+    cum -= np.repeat(cum[starts], lengths)
+    total = np.repeat(cum[ends], lengths)
+    t = np.divide(cum, total, out=np.zeros_like(cum), where=total > 0)
+
+    ## Flip streamlines whose endpoints are swapped compared to the longest streamline
+    ref = np.argmax(cum[ends])
+    ref_start, ref_end = pts[starts[ref]], pts[ends[ref]]
+    same = np.linalg.norm(pts[starts] - ref_start, axis=1) + np.linalg.norm(pts[ends] - ref_end, axis=1)
+    swapped = np.linalg.norm(pts[starts] - ref_end, axis=1) + np.linalg.norm(pts[ends] - ref_start, axis=1)
+    flipped = np.repeat(swapped < same, lengths)
+    t[flipped] = 1 - t[flipped]
+
+    return np.minimum((t * num_segments).astype(int), num_segments - 1)
 
 class Tract(Colors_csv):
 
@@ -18,28 +51,34 @@ class Tract(Colors_csv):
         self.tract_width = tw
         self.bundle_shape = bundle_shape
         self.affine = aff
+        self.lut = None
 
-    def selt_colormap(self,instance):
+    def selt_colormap(self,instance,lut=None):
         self.colors_from_csv = instance
+        self.lut = lut
+
+    def paint_labels(self,streamlines,labels,colors):
+        """
+        Builds the line actor from one label per point, label 0 being drawn black and
+        label i with colors[i-1]. Labels outside the colors (negative or too large) are
+        drawn as label 0. When a lookup table is set the labels stay on the actor so it
+        can be recolored without rebuilding the geometry.
+        """
+        table = np.vstack([[0.0,0.0,0.0],np.asarray(colors,dtype=float)[:, :3]])
+        ## A negative label would wrap around to the last colors
+        labels = np.asarray(labels)
+        labels = np.where((labels >= 0) & (labels < len(table)), labels, 0)
+        stream_actor = actor.line(streamlines, fake_tube=True, colors=table[labels],linewidth=self.tract_width)
+        if self.lut is not None:
+            map_actor_through_lut(stream_actor,labels,self.lut)
+        return stream_actor
 
     def with_colormap(self,mask):
-        self.pts = [item for sublist in self.bundle for item in sublist]
+        self.pts = np.concatenate([np.asarray(s) for s in self.bundle])
         nifti_data = mask.get_fdata()
-        voxels = np.round(nib.affines.apply_affine(np.linalg.inv(mask.affine), self.pts))
-        nifti_dict = {(i, j, k): val for (i, j, k), val in np.ndenumerate(nifti_data)}
-        master_color = list(map(lambda vox: nifti_dict[abs(vox[0]), abs(vox[1]), abs(vox[2])], voxels))
-        master_color = np.asarray(master_color).astype(int)
-        nb_streams = len(np.unique(self.pts))
-        disks_color = [] 
-        print(nb_streams)
-        for i in range(len(master_color)):
-            print(i,master_color[i])
-            if master_color[i]==0:
-                disks_color.append(tuple([0.0,0.0,0.0]))
-            else:
-                disks_color.append(tuple(self.colors_from_csv[master_color[i]-1]))
-        stream_actor = actor.line(self.bundle, fake_tube=True, colors=disks_color,linewidth=self.tract_width)
-        return stream_actor
+        voxels = np.abs(np.round(nib.affines.apply_affine(np.linalg.inv(mask.affine), self.pts))).astype(int)
+        master_color = nifti_data[voxels[:,0],voxels[:,1],voxels[:,2]].astype(int)
+        return self.paint_labels(self.bundle,master_color,self.colors_from_csv)
     
     def single_color(self):
         stream_actor = actor.line(self.bundle,colors=self.colors,lod=False,fake_tube = True,linewidth=self.tract_width)
@@ -67,6 +106,10 @@ class Tract(Colors_csv):
 
 
         if method=="Center":
+            from scipy.spatial import cKDTree
+            from dipy.segment.clustering import QuickBundles
+            from dipy.segment.metric import AveragePointwiseEuclideanMetric
+            from dipy.tracking.streamline import Streamlines, set_number_of_points
             mbundle_streamlines = set_number_of_points(model_bundle, nb_points=no_disks)
 
             metric = AveragePointwiseEuclideanMetric()
@@ -78,6 +121,8 @@ class Tract(Colors_csv):
             _, indx = cKDTree(centroids.get_data(), 1, copy_data=True).query(
             target_bundle.get_data(), k=k)
             return indx
+        if method=="ArcLength":
+            return arc_length_segments(target_bundle, no_disks)
         if method=="Meta":
             # print(target_bundle)
             if np.array_equal(self.affine, target_bundle.affine) :
@@ -102,12 +147,13 @@ class Tract(Colors_csv):
         
 
     def tracts_paint(self,method,number_of_streams):
+        import distinctipy
         # print("AT TractPaint")
 
         if len(self.colors_from_csv)>1: nb_streams = len(self.colors_from_csv)
         else: nb_streams = number_of_streams
-        if method=="Center": 
-            indx = self.assignment_map_(self.bundle.streamlines, self.bundle.streamlines, nb_streams,threshold=np.inf,method="Center")  
+        if method=="Center" or method=="ArcLength": 
+            indx = self.assignment_map_(self.bundle.streamlines, self.bundle.streamlines, nb_streams,threshold=np.inf,method=method)  
 
             indx = np.array(indx)
             print(indx.shape)
@@ -116,38 +162,21 @@ class Tract(Colors_csv):
                 colors = distinctipy.get_colors(nb_streams)
             else:
                 colors = self.colors_from_csv
-            disks_color = []
-            for i in range(len(indx)):
-                disks_color.append(tuple(colors[indx[i]]))
-            # print(disks_color)
-            stream_actor = actor.line(self.bundle.streamlines, fake_tube=True, colors=disks_color,linewidth=self.tract_width)
-            return stream_actor
+            return self.paint_labels(self.bundle.streamlines,indx+1,colors)
         if method=="Meta":
             mask = self.assignment_map_(self.bundle,self.bundle,nb_streams,method="Meta")
             # self.bundle = self.bundle.streamlines
-            self.pts = [item for sublist in self.bundle for item in sublist]
+            self.pts = np.concatenate([np.asarray(s) for s in self.bundle])
             nifti_data = mask
             print(nifti_data.shape,self.affine)
-            voxels = np.round(nib.affines.apply_affine(np.linalg.inv(self.affine), self.pts))
-            nifti_dict = {(i, j, k): val for (i, j, k), val in np.ndenumerate(nifti_data)}
-            master_color = list(map(lambda vox: nifti_dict[abs(vox[0]), abs(vox[1]), abs(vox[2])], voxels))
-            master_color = np.asarray(master_color).astype(int)
-            # nb_streams = len(np.unique(self.pts))
+            voxels = np.abs(np.round(nib.affines.apply_affine(np.linalg.inv(self.affine), self.pts))).astype(int)
+            master_color = nifti_data[voxels[:,0],voxels[:,1],voxels[:,2]].astype(int)
             print(nb_streams)
-            disks_color = [] 
             if len(self.colors_from_csv)<1:
                 colors = distinctipy.get_colors(nb_streams)
             else:
                 colors = self.colors_from_csv
-            print(self.colors_from_csv)
-            for i in range(len(master_color)):
-                print(i,master_color[i])
-                if master_color[i]==0:
-                    disks_color.append(tuple([0.0,0.0,0.0]))
-                else:
-                    disks_color.append(tuple(colors[master_color[i]-1]))
-            stream_actor = actor.line(self.bundle, fake_tube=True, colors=disks_color,linewidth=self.tract_width)
-            return stream_actor
+            return self.paint_labels(self.bundle,master_color,colors)
             # indx = np.array(indx)
             # print(indx.shape)
             # print(np.unique(indx))
@@ -161,4 +190,103 @@ class Tract(Colors_csv):
             # # print(disks_color)
             # stream_actor = actor.line(self.bundle.streamlines, fake_tube=True, colors=disks_color,linewidth=self.tract_width)
             # return stream_actor
-            # self.with_colormap(maskk)
\ No newline at end of file
+            # self.with_colormap(maskk)
+
+
+class TractBatch:
+    """
+    Draws many bundles with a single line actor. The streamlines of all the bundles are
+    concatenated and every point carries its bundle number, so the color, opacity and
+    visibility of a bundle are entries of a lookup table instead of separate actors.
+    """
+
+    def __init__(self,tw=1):
+        self.tract_width = tw
+        self.names = []
+        self.bundles = []
+        self.colors = []
+        self.opacity = []
+        self.visible = []
+        self.lut = None
+        self.actor = None
+
+    def add_bundle(self,name,bundle,color):
+        """
+        Args:
+            name: name of the bundle in the viewer
+            bundle: ArraySequence of the streamlines
+            color: RGB color in [0, 1]
+        """
+        self.names.append(name)
+        self.bundles.append(bundle)
+        self.colors.append(tuple(color[:3]))
+        self.opacity.append(1.0)
+        self.visible.append(True)
+
+    def build(self):
+        """
+        Returns: the line actor of all the bundles, bundle i (from 0) is label i+1 of the lookup table
+        """
+        streamlines = ArraySequence()
+        for bundle in self.bundles:
+            streamlines.extend(bundle)
+        labels = np.repeat(np.arange(1,len(self.bundles)+1),[bundle.total_nb_rows for bundle in self.bundles])
+        self.lut = colors_to_lut(self.colors)
+        tract_caller = Tract(bundle = streamlines,tw=self.tract_width)
+        tract_caller.selt_colormap(instance=None,lut=self.lut)
+        self.actor = tract_caller.paint_labels(streamlines,labels,self.colors)
+        ## The bundles are only needed until the geometry is built
+        self.bundles = []
+        return self.actor
+
+    def update_entry(self,index):
+        alpha = self.opacity[index] if self.visible[index] else 0.0
+        self.lut.SetTableValue(index+1,*self.colors[index],alpha)
+        self.lut.Modified()
+
+    def handles(self):
+        """
+        Returns: dict of bundle name to its BundleView, to use in place of actors in the viewer ROIs
+        """
+        return {name: BundleView(self,index) for index, name in enumerate(self.names)}
+
+
+class BundleView:
+    """
+    One bundle of a TractBatch, answering the property calls the viewer makes on actors
+    (opacity, color, visibility) by updating the bundle's lookup table entry.
+    """
+
+    def __init__(self,batch,index):
+        self.batch = batch
+        self.index = index
+
+    def GetProperty(self):
+        return self
+
+    def SetOpacity(self,value):
+        self.batch.opacity[self.index] = float(value)
+        self.batch.update_entry(self.index)
+
+    def GetOpacity(self):
+        return self.batch.opacity[self.index]
+
+    def SetColor(self,*color):
+        self.batch.colors[self.index] = tuple(np.ravel(color)[:3])
+        self.batch.update_entry(self.index)
+
+    def GetColor(self):
+        return self.batch.colors[self.index]
+
+    def SetVisibility(self,flag):
+        self.batch.visible[self.index] = bool(flag)
+        self.batch.update_entry(self.index)
+
+    def GetVisibility(self):
+        return int(self.batch.visible[self.index])
+
+    def VisibilityOn(self):
+        self.SetVisibility(True)
+
+    def VisibilityOff(self):
+        self.SetVisibility(False)